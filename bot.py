@@ -11,15 +11,21 @@
 # ║  • Existing plaintext rows auto-handled (dec fallback)      ║
 # ╚══════════════════════════════════════════════════════════════╝
 
-import os, json, logging, requests, html as hl, time, base64
-from threading import Thread
+import os, re, json, math, logging, html as hl, time, base64, asyncio, select, sqlite3, itertools
+from bisect import bisect_left
+from threading import Thread, Condition, Lock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from uuid import uuid4
 from datetime import datetime, timedelta
 from cryptography.fernet import Fernet, InvalidToken
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton as _IB
-from telegram.ext import (ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-                           MessageHandler, ContextTypes, filters)
+from telegram import (Update, InlineKeyboardMarkup, InlineKeyboardButton as _IB,
+                      InlineQueryResultArticle, InputTextMessageContent)
+from telegram.ext import (ApplicationBuilder, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler,
+                           MessageHandler, InlineQueryHandler, ContextTypes, filters)
+from telegram.error import RetryAfter, Forbidden, BadRequest
+import httpx
 import psycopg2
 import psycopg2.extras
 
@@ -66,68 +72,271 @@ DATABASE_URL = os.getenv("DATABASE_URL", "")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL environment variable not set.")
 
+DB_POOL_MIN  = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX  = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_IDLE = int(os.getenv("DB_POOL_IDLE", "300"))   # seconds an idle conn may sit in the pool
+DB_POOL_PING = int(os.getenv("DB_POOL_PING", "30"))    # re-check conns idle longer than this on checkout
+PRINCIPAL_TTL = int(os.getenv("PRINCIPAL_TTL", "30"))  # seconds a resolved uid→role lookup is reused
+SETTINGS_NOTIFY = os.getenv("SETTINGS_NOTIFY", "0") == "1"  # LISTEN/NOTIFY so every instance sees ss() writes
+VIEW_FLUSH    = int(os.getenv("VIEW_FLUSH", "30"))     # seconds between batched product view-count writes
+CART_FLUSH    = int(os.getenv("CART_FLUSH", "10"))     # seconds between write-behind basket flushes
+CART_IDLE     = int(os.getenv("CART_IDLE", "3600"))    # clean baskets untouched this long leave memory
+HOLD_TTL      = int(os.getenv("HOLD_TTL", "900"))      # seconds checkout holds basket stock before release
+OUT_RATE      = float(os.getenv("OUT_RATE", "25"))     # outgoing messages per second, all chats (Telegram allows ~30)
+BCAST_CONC    = int(os.getenv("BCAST_CONC", "20"))     # broadcast messages queued at once
+BCAST_BATCH   = 100                                    # recipients claimed and persisted per round
+BCAST_PROGRESS = 5                                     # seconds between progress edits to the admin
+ORDER_HOLD    = 49 * 3600                              # pending-order holds outlive the 48h auto-expire
+
 def db():
     conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
     conn.autocommit = False
     return conn
 
+class _Pool:
+    """Thread-safe connection pool behind q1/qa/qx/qxi.
+    Checkout health-checks connections that sat idle, reap() closes ones idle too long.
+    """
+    def __init__(self, minconn, maxconn, idle, ping):
+        self.minconn, self.maxconn, self.idle, self.ping = minconn, maxconn, idle, ping
+        self._free = []   # [(conn, last_used)] — most recently used at the end
+        self._out  = 0    # connections currently checked out
+        self._cond = Condition()
+
+    def _ok(self, conn, last_used):
+        if conn.closed: return False
+        if time.time() - last_used < self.ping: return True
+        try:
+            cur = conn.cursor(); cur.execute("SELECT 1"); conn.rollback(); return True
+        except Exception: return False
+
+    def get(self, timeout=30):
+        deadline = time.time() + timeout
+        while True:
+            with self._cond:
+                while not self._free and self._out >= self.maxconn:
+                    left = deadline - time.time()
+                    if left <= 0: raise RuntimeError("DB pool exhausted")
+                    self._cond.wait(left)
+                self._out += 1
+                item = self._free.pop() if self._free else None
+            if item is None:
+                try: return db()
+                except Exception: self._release(); raise
+            conn, last_used = item
+            if self._ok(conn, last_used): return conn
+            self._discard(conn)
+
+    def put(self, conn):
+        if not conn.closed:
+            try:
+                st = conn.get_transaction_status()
+                if st == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN: raise psycopg2.InterfaceError
+                if st != psycopg2.extensions.TRANSACTION_STATUS_IDLE: conn.rollback()
+            except Exception:
+                self._discard(conn); return
+        if conn.closed: self._release(); return
+        with self._cond:
+            self._free.append((conn, time.time())); self._out -= 1; self._cond.notify()
+
+    def _release(self):
+        with self._cond: self._out -= 1; self._cond.notify()
+
+    def _discard(self, conn):
+        try: conn.close()
+        except Exception: pass
+        self._release()
+
+    def reap(self):
+        """Close connections idle longer than DB_POOL_IDLE, keeping DB_POOL_MIN warm."""
+        cutoff = time.time() - self.idle
+        with self._cond:
+            keep = max(self.minconn - self._out, 0)
+            stale = [c for c, ts in self._free[:max(len(self._free) - keep, 0)] if ts < cutoff]
+            self._free = [(c, ts) for c, ts in self._free if c not in stale]
+        for c in stale:
+            try: c.close()
+            except Exception: pass
+        return len(stale)
+
+    def stats(self):
+        with self._cond: return {"free": len(self._free), "out": self._out, "max": self.maxconn}
+
+POOL = _Pool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_IDLE, DB_POOL_PING)
+
+@contextmanager
+def pooled():
+    conn = POOL.get()
+    try: yield conn
+    finally: POOL.put(conn)
+
 def _sql(s):
     """Convert SQLite ? placeholders to PostgreSQL %s"""
     return s.replace("?", "%s")
 
 def q1(s, p=()):
-    conn = db()
-    try:
+    with pooled() as conn:
         cur = conn.cursor()
         cur.execute(_sql(s), p)
         r = cur.fetchone()
         return dict(r) if r else None
-    finally:
-        conn.close()
 
 def qa(s, p=()):
-    conn = db()
-    try:
+    with pooled() as conn:
         cur = conn.cursor()
         cur.execute(_sql(s), p)
         return [dict(r) for r in cur.fetchall()]
-    finally:
-        conn.close()
 
 def qx(s, p=()):
-    conn = db()
-    try:
-        cur = conn.cursor()
-        cur.execute(_sql(s), p)
-        conn.commit()
-    except Exception as e:
-        conn.rollback(); raise
-    finally:
-        conn.close()
+    with pooled() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(s), p)
+            conn.commit()
+        except Exception as e:
+            conn.rollback(); raise
 
 def qxi(s, p=()):
     """Execute INSERT and return the generated id via RETURNING id"""
-    conn = db()
-    try:
-        cur = conn.cursor()
+    with pooled() as conn:
+        try:
+            cur = conn.cursor()
+            sql = _sql(s)
+            if "RETURNING" not in sql.upper():
+                sql = sql.rstrip(";") + " RETURNING id"
+            cur.execute(sql, p)
+            r = cur.fetchone()
+            conn.commit()
+            return r["id"] if r else None
+        except Exception as e:
+            conn.rollback(); raise
+
+# ── TRANSACTIONS ───────────────────────────────────────────────────────────────
+class _Tx:
+    """q1/qa/qx/qxi bound to one connection; nothing is committed until tx() exits.
+    Callables appended to .after run once the commit has succeeded."""
+    def __init__(self, conn): self.conn = conn; self.cur = conn.cursor(); self.after = []
+    def q1(self, s, p=()):
+        self.cur.execute(_sql(s), p); r = self.cur.fetchone()
+        return dict(r) if r else None
+    def qa(self, s, p=()):
+        self.cur.execute(_sql(s), p); return [dict(r) for r in self.cur.fetchall()]
+    def qx(self, s, p=()):
+        self.cur.execute(_sql(s), p)
+    def qxi(self, s, p=()):
         sql = _sql(s)
         if "RETURNING" not in sql.upper():
             sql = sql.rstrip(";") + " RETURNING id"
-        cur.execute(sql, p)
-        r = cur.fetchone()
-        conn.commit()
+        self.cur.execute(sql, p); r = self.cur.fetchone()
         return r["id"] if r else None
-    except Exception as e:
-        conn.rollback(); raise
-    finally:
-        conn.close()
+
+@contextmanager
+def tx():
+    """Run a multi-statement flow on one pooled connection with a single commit:
+        with tx() as t: t.qx(...); add_timeline(oid, "...", t)
+    Any exception rolls the whole flow back."""
+    with pooled() as conn:
+        t = _Tx(conn)
+        try:
+            yield t
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+    for fn in t.after: fn()
+
+# Autocommit stand-in so helpers can take an optional t=None and run either way
+class AUTO:
+    q1 = staticmethod(q1); qa = staticmethod(qa); qx = staticmethod(qx); qxi = staticmethod(qxi)
+
+# ── ASYNC DB ───────────────────────────────────────────────────────────────────
+# Handlers await these instead of calling q1/qa/qx directly, so one user's query
+# never blocks the event loop for everyone else. Sized to the pool so workers
+# never queue on a connection.
+DB_EXEC = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+async def arun(fn, *a):
+    """Run a blocking helper on the DB executor."""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXEC, fn, *a)
+
+async def aq1(s, p=()):  return await arun(q1, s, p)
+async def aqa(s, p=()):  return await arun(qa, s, p)
+async def aqx(s, p=()):  return await arun(qx, s, p)
+async def aqxi(s, p=()): return await arun(qxi, s, p)
+
+# ── UPDATE DISPATCH ────────────────────────────────────────────────────────────
+# Different users' updates run concurrently, at most DB_POOL_MAX at once, so one
+# slow query only holds up the user who asked for it. A user's own updates still
+# run one at a time and in order, so ctx.user_data workflow and checkout keys are
+# never touched by two handlers at once. Updates waiting their user's turn don't
+# take a running slot.
+class _PerUserUpdates(BaseUpdateProcessor):
+    def __init__(self, running, backlog=256):
+        super().__init__(backlog)
+        self._run, self._users = asyncio.Semaphore(running), {}  # uid -> [lock, updates]
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._run: await coroutine
+            return
+        slot = self._users.setdefault(user.id, [asyncio.Lock(), 0]); slot[1] += 1
+        try:
+            async with slot[0], self._run: await coroutine
+        finally:
+            slot[1] -= 1
+            if not slot[1]: self._users.pop(user.id, None)
+
+    async def initialize(self): pass
+    async def shutdown(self): pass
+
+# ── SETTINGS ───────────────────────────────────────────────────────────────────
+# Whole table is held in memory: gs() never queries, ss() writes through.
+# _SETTINGS_VER moves on every change so derived caches (pricing_policy) can tell.
+_SETTINGS, _SETTINGS_VER = None, 0
+
+def _load_settings():
+    global _SETTINGS, _SETTINGS_VER
+    _SETTINGS = {r["key"]: r["value"] for r in qa("SELECT key,value FROM settings")}
+    _SETTINGS_VER += 1
+    return _SETTINGS
 
 def gs(k, d=""):
-    r = q1("SELECT value FROM settings WHERE key=%s", (k,))
-    return r["value"] if r else d
+    cache = _SETTINGS if _SETTINGS is not None else _load_settings()
+    return cache[k] if k in cache else d
 
 def ss(k, v):
-    qx("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT(key) DO UPDATE SET value=%s", (k, v, v))
+    global _SETTINGS_VER
+    with tx() as t:
+        t.qx("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT(key) DO UPDATE SET value=%s", (k, v, v))
+        if SETTINGS_NOTIFY: t.qx("SELECT pg_notify('settings', %s)", (k,))
+    if _SETTINGS is not None: _SETTINGS[k] = v
+    _SETTINGS_VER += 1
+
+def settings_listener():
+    """Background thread: refresh keys changed by other instances (SETTINGS_NOTIFY=1).
+    Reloads the whole cache after every (re)connect so missed notifies don't linger."""
+    global _SETTINGS_VER
+    while True:
+        conn = None
+        try:
+            conn = db(); conn.autocommit = True
+            conn.cursor().execute("LISTEN settings")
+            _load_settings()
+            while True:
+                if not select.select([conn], [], [], 60)[0]: continue
+                conn.poll()
+                while conn.notifies:
+                    k = conn.notifies.pop(0).payload
+                    r = q1("SELECT value FROM settings WHERE key=?", (k,))
+                    if r: _SETTINGS[k] = r["value"]
+                    else: _SETTINGS.pop(k, None)
+                    _SETTINGS_VER += 1
+        except Exception as e:
+            print(f"⚠️ Settings listener: {e}"); time.sleep(5)
+        finally:
+            if conn:
+                try: conn.close()
+                except Exception: pass
 
 print("🗄️  Database: PostgreSQL  |  🔒 Encryption: Fernet AES-128")
 
@@ -144,13 +353,13 @@ TIERS = [
 STARS      = {1:"⭐",2:"⭐⭐",3:"⭐⭐⭐",4:"⭐⭐⭐⭐",5:"⭐⭐⭐⭐⭐"}
 VIP_LEVELS = [("Diamond","💎",1500),("Gold","🥇",500),("Silver","🥈",200),("Bronze","🥉",50)]
 RPP        = 5
-LTC_CACHE  = {"rate": 0.0, "ts": 0}
+ORDERS_PP  = 8   # orders per My Orders page
 
-def get_vendor_wallet(vid):
+def get_vendor_wallet(vid, t=None):
     """Return the active crypto address for a specific vendor.
     Falls back to PLATFORM_LTC if none set.
     """
-    r = q1("SELECT address FROM crypto_wallets WHERE vendor_id=? AND is_active=1 ORDER BY id DESC LIMIT 1", (vid,))
+    r = (t or AUTO).q1("SELECT address FROM crypto_wallets WHERE vendor_id=? AND is_active=1 ORDER BY id DESC LIMIT 1", (vid,))
     return r["address"] if r else PLATFORM_LTC
 
 # Legacy alias kept for any remaining references
@@ -330,6 +539,49 @@ def init_db():
             created_at TIMESTAMP DEFAULT NOW())
         """,
         "ALTER TABLE crypto_wallets ADD COLUMN IF NOT EXISTS vendor_id INTEGER NOT NULL DEFAULT 1",
+        # Drop-chat open/closed lived in settings as cc_<order_id>; move it onto the order row
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS chat_closed INTEGER DEFAULT 0",
+        # ltc_transactions.confirmed: 0 waiting on confirmations, 1 settled, -1 given up (dropped or stuck)
+        "ALTER TABLE ltc_transactions ADD COLUMN IF NOT EXISTS confirmations INTEGER DEFAULT 0",
+        # Older detections stored confirmed=0 while already marking the order Paid; settle them
+        "UPDATE ltc_transactions l SET confirmed=1 FROM orders o "
+        "WHERE o.id=l.order_id AND l.confirmed=0 AND o.status<>'Pending'",
+        "CREATE INDEX IF NOT EXISTS ltc_transactions_unconfirmed ON ltc_transactions(txid) WHERE confirmed=0",
+        "CREATE INDEX IF NOT EXISTS orders_user_created ON orders(user_id, created_at DESC, id DESC)",
+        # Reserved stock: checkout holds (order_id NULL) and pending-order holds
+        """CREATE TABLE IF NOT EXISTS stock_holds(
+            id SERIAL PRIMARY KEY,
+            product_id INTEGER NOT NULL, user_id BIGINT NOT NULL,
+            order_id TEXT, n INTEGER NOT NULL,
+            expires TIMESTAMP NOT NULL)
+        """,
+        "CREATE INDEX IF NOT EXISTS stock_holds_product ON stock_holds(product_id, expires)",
+        "CREATE INDEX IF NOT EXISTS stock_holds_order ON stock_holds(order_id)",
+        # Highest block height the payment detector has fully scanned, per wallet
+        """CREATE TABLE IF NOT EXISTS chain_cursors(
+            addr TEXT PRIMARY KEY, height INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW())""",
+        # Incoming payments the cursor moved past without an order to match
+        """CREATE TABLE IF NOT EXISTS chain_unmatched(
+            txid TEXT PRIMARY KEY, addr TEXT NOT NULL, sat BIGINT NOT NULL,
+            confirmations INTEGER DEFAULT 0, seen_at TIMESTAMP DEFAULT NOW())""",
+        "CREATE INDEX IF NOT EXISTS chain_unmatched_addr ON chain_unmatched(addr, seen_at)",
+        # Announcement broadcasts: status running/done/cancelled; recipient state 0 queued, 1 sent, 2 failed
+        """CREATE TABLE IF NOT EXISTS broadcasts(
+            id SERIAL PRIMARY KEY, announcement_id INTEGER NOT NULL,
+            admin_id BIGINT, status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+            progress_chat BIGINT, progress_msg INTEGER,
+            created_at TIMESTAMP DEFAULT NOW(), finished_at TIMESTAMP)""",
+        """CREATE TABLE IF NOT EXISTS broadcast_recipients(
+            broadcast_id INTEGER NOT NULL, user_id BIGINT NOT NULL,
+            state SMALLINT DEFAULT 0, attempts INTEGER DEFAULT 0,
+            PRIMARY KEY(broadcast_id, user_id))""",
+        """WITH moved AS (
+            UPDATE orders o SET chat_closed=1 FROM settings s
+            WHERE s.key='cc_'||o.id AND s.value='1' RETURNING o.id)
+        DELETE FROM settings WHERE key LIKE 'cc\\_%'
+        """,
     ]
     for m in migrations:
         try: cur.execute(m); conn.commit()
@@ -347,6 +599,7 @@ def init_db():
         ("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT DO NOTHING", ("min_order","0")),
         ("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT DO NOTHING", ("bulk_threshold","100")),
         ("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT DO NOTHING", ("bulk_pct","5")),
+        ("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT DO NOTHING", ("pay_confs","1")),
         ("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT DO NOTHING", ("ref_reward_orders","15")),
         ("INSERT INTO settings(key,value) VALUES(%s,%s) ON CONFLICT DO NOTHING", ("ref_reward_msg","🎉 Referral reward! Free delivery on your next order.")),
     ]
@@ -363,11 +616,44 @@ def init_db():
     print("✅ Database initialised")
 
 # ── CORE HELPERS ───────────────────────────────────────────────────────────────
-def is_admin(uid):        return uid == ADMIN_ID or bool(q1("SELECT 1 FROM admins WHERE user_id=?", (uid,)))
-def is_known(uid):        return bool(q1("SELECT 1 FROM users WHERE user_id=?", (uid,)))
-def is_banned(uid):       r = q1("SELECT banned FROM users WHERE user_id=?", (uid,)); return bool(r and r.get("banned"))
-def get_vendor(uid):      return q1("SELECT * FROM vendors WHERE admin_user_id=? AND active=1", (uid,))
-def is_vendor_admin(uid): return not is_admin(uid) and bool(get_vendor(uid))
+_PRINCIPALS = {}  # uid -> (loaded_at, {"banned","known","admin","vendor"})
+
+def principal(uid):
+    """Ban/admin/vendor/known flags for uid, resolved in one query and cached
+    for PRINCIPAL_TTL seconds. Writers call forget_principal() to refresh."""
+    hit = _PRINCIPALS.get(uid)
+    if hit and time.monotonic() - hit[0] < PRINCIPAL_TTL: return hit[1]
+    r = q1("SELECT (SELECT banned FROM users WHERE user_id=?) AS banned,"
+           " EXISTS(SELECT 1 FROM users WHERE user_id=?) AS known,"
+           " EXISTS(SELECT 1 FROM admins WHERE user_id=?) AS admin,"
+           " (SELECT row_to_json(v) FROM vendors v WHERE admin_user_id=? AND active=1 LIMIT 1) AS vendor",
+           (uid, uid, uid, uid)) or {}
+    p = {"banned": bool(r.get("banned")), "known": bool(r.get("known")),
+         "admin": uid == ADMIN_ID or bool(r.get("admin")), "vendor": r.get("vendor")}
+    _PRINCIPALS[uid] = (time.monotonic(), p)
+    return p
+
+def forget_principal(uid=None):
+    """Drop one cached principal, or all of them (vendor edits/toggles)."""
+    if uid is None: _PRINCIPALS.clear()
+    else: _PRINCIPALS.pop(uid, None)
+
+def is_admin(uid):        return uid == ADMIN_ID or principal(uid)["admin"]
+def is_known(uid):        return principal(uid)["known"]
+def is_banned(uid):       return principal(uid)["banned"]
+def get_vendor(uid):      return principal(uid)["vendor"]
+def is_vendor_admin(uid): p = principal(uid); return not p["admin"] and bool(p["vendor"])
+def gate(uid, username=""):
+    """Ban/registration check run once per update by router and on_message.
+    Returns "banned", "unknown" or None; staff are registered on the fly."""
+    p = principal(uid)
+    if p["banned"]: return "banned"
+    if p["admin"] or p["vendor"]:
+        if not p["known"]:
+            qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING", (uid, username or ""))
+            forget_principal(uid)
+    elif not p["known"]: return "unknown"
+    return None
 def get_vid(ctx, uid):
     v = get_vendor(uid)
     if v:
@@ -388,17 +674,227 @@ def KM(*rows): return InlineKeyboardMarkup(list(rows))
 def back_kb():   return KM([IB("⬅️ Back", "menu")])
 def cancel_kb(): return KM([IB("❌ Cancel", "menu")])
 
-def ltc_price(force=False):
-    now = time.time()
-    if not force and LTC_CACHE["rate"] > 0 and now - LTC_CACHE["ts"] < 120:
-        return LTC_CACHE["rate"]
-    try:
-        r = requests.get(
-            "https://api.coingecko.com/api/v3/simple/price?ids=litecoin&vs_currencies=gbp",
-            timeout=8).json()["litecoin"]["gbp"]
-        LTC_CACHE["rate"] = r; LTC_CACHE["ts"] = now; return r
-    except:
-        return LTC_CACHE["rate"] if LTC_CACHE["rate"] > 0 else 60.0
+# ── LTC RATE ───────────────────────────────────────────────────────────────────
+# GBP/LTC comes from a background-refreshed service: handlers never wait on
+# CoinGecko unless the cached rate is older than RATE_STALE, and concurrent
+# refreshes share one request. RATE_STUB=<gbp> swaps in a fixed local provider.
+RATE_TTL   = int(os.getenv("RATE_TTL", "60"))     # seconds before a rate is refreshed
+RATE_STALE = int(os.getenv("RATE_STALE", "600"))  # oldest rate checkout will quote with
+RATE_STUB  = os.getenv("RATE_STUB")
+
+class CoinGecko:
+    name = "CoinGecko"
+    def __init__(self): self.client = None
+    async def __call__(self):
+        if self.client is None: self.client = httpx.AsyncClient(timeout=8)
+        r = await self.client.get("https://api.coingecko.com/api/v3/simple/price",
+                                  params={"ids": "litecoin", "vs_currencies": "gbp"})
+        r.raise_for_status()
+        return float(r.json()["litecoin"]["gbp"])
+    async def aclose(self):
+        if self.client: await self.client.aclose(); self.client = None
+
+class StubRate:
+    """Fixed rate, no network."""
+    name = "stub"
+    def __init__(self, rate): self.rate = float(rate)
+    async def __call__(self): return self.rate
+    async def aclose(self): pass
+
+class _Rates:
+    def __init__(self, provider):
+        self.provider, self.rate, self.ts, self._flight = provider, 0.0, 0.0, None
+
+    def age(self): return time.time() - self.ts if self.ts else None
+
+    def info(self):
+        """Provenance line for admin screens, e.g. 'CoinGecko · 42s ago'."""
+        a = self.age()
+        return f"{self.provider.name} · {int(a)}s ago" if a is not None else "no rate yet"
+
+    async def _fetch(self):
+        try:
+            self.rate = await self.provider(); self.ts = time.time()
+        except Exception as e: print(f"⚠️ LTC rate ({self.provider.name}): {e}")
+
+    def _start(self):
+        """The fetch in flight, starting one if none is. Kept on self so a
+        background revalidation can't be garbage-collected mid-flight."""
+        if self._flight is None or self._flight.done():
+            self._flight = asyncio.get_running_loop().create_task(self._fetch())
+        return self._flight
+
+    async def refresh(self):
+        """Single-flight: every caller during a fetch awaits the same one."""
+        await asyncio.shield(self._start())
+
+    async def get(self):
+        """A rate no older than RATE_STALE, or None. Within RATE_STALE a stale
+        rate is served at once and revalidated in the background."""
+        a = self.age()
+        if a is None or a > RATE_STALE: await self.refresh(); a = self.age()
+        elif a > RATE_TTL: self._start()
+        return self.rate if a is not None and a <= RATE_STALE else None
+
+RATES = _Rates(StubRate(RATE_STUB) if RATE_STUB else CoinGecko())
+
+def ltc_price():
+    """Last known rate for display only (60.0 before the first fetch); never blocks."""
+    return RATES.rate or 60.0
+
+# ── CHAIN ──────────────────────────────────────────────────────────────────────
+# Payment detection and wallet screens talk to CHAIN only. A provider answers
+# address_txs(addr, since) → [{"txid", "sat", "confirmations", "height"}] (sat =
+# litoshis paid to addr, height None while unconfirmed) covering every tx above
+# block `since` plus the unconfirmed ones — or just the latest page if since is
+# None — balance(addr) → (confirmed_sat, unconfirmed_sat) and confirmations(txids)
+# → {txid: n} for a batch of txs, leaving out any the provider no longer knows.
+# CHAIN_FAKE=<sqlite file> swaps BlockCypher for a local replay of synthetic txs.
+CHAIN_FAKE  = os.getenv("CHAIN_FAKE")
+CHAIN_TRIES = 4   # attempts per request when rate limited
+CHAIN_REORG = 6   # blocks behind the cursor that are rescanned in case of a reorg
+CHAIN_UNMATCHED = 48  # hours an incoming payment that matched no order is re-checked against new ones
+CHAIN_SCANS = int(os.getenv("CHAIN_SCANS", "4"))   # wallets the detector scans at once
+CHAIN_RPS   = float(os.getenv("CHAIN_RPS", "3"))   # requests per second allowed to BlockCypher
+CHAIN_SCAN  = int(os.getenv("CHAIN_SCAN", "300"))  # seconds between full wallet scans
+CONF_POLL   = int(os.getenv("CONF_POLL", "30"))    # seconds between confirmation polls of seen txs
+CONF_BATCH  = 50  # txids per batched confirmation request
+PAY_GIVEUP  = int(os.getenv("PAY_GIVEUP", "24"))   # hours a seen payment may stay unconfirmed before its order reopens
+PAY_DROP    = 600  # seconds a seen tx may be missing from the provider (propagation) before it counts as dropped
+SAT = 100000000
+
+class ChainError(Exception): pass
+class ChainMissing(ChainError): pass
+
+class BlockCypher:
+    name = "BlockCypher"
+    base = "https://api.blockcypher.com/v1/ltc/main"
+
+    def __init__(self, token=None, rps=CHAIN_RPS):
+        self.params = {"token": token} if token else {}; self.client = None
+        self.gap, self.next, self.pace_lock = 1 / rps, 0.0, asyncio.Lock()
+
+    async def _pace(self):
+        """Space requests gap seconds apart across every concurrent caller."""
+        async with self.pace_lock:
+            now = time.monotonic(); wait = self.next - now
+            self.next = max(now, self.next) + self.gap
+        if wait > 0: await asyncio.sleep(wait)
+
+    async def _get(self, path, **params):
+        """GET with one shared keep-alive client; 429s back off (Retry-After if given)."""
+        if self.client is None: self.client = httpx.AsyncClient(timeout=15)
+        for i in range(CHAIN_TRIES):
+            await self._pace()
+            r = await self.client.get(self.base + path, params={**self.params, **params})
+            if r.status_code != 429: break
+            try: wait = float(r.headers.get("Retry-After", ""))
+            except ValueError: wait = 2 ** i
+            await asyncio.sleep(min(wait, 30))
+        else: raise ChainError(f"{self.name} rate limited")
+        if r.status_code == 404: raise ChainMissing(f"{self.name} {path} not found")
+        if r.status_code != 200: raise ChainError(f"{self.name} HTTP {r.status_code}")
+        return r.json()
+
+    async def address_txs(self, addr, since=None, limit=50):
+        """Newest first, paging back with `before` while BlockCypher has more."""
+        out, params = {}, {"limit": limit}
+        if since is not None: params["after"] = since
+        while True:
+            d = await self._get(f"/addrs/{addr}/full", **params)
+            for t in d.get("txs", []):
+                if not t.get("hash"): continue
+                h = t.get("block_height", -1)
+                out[t["hash"]] = {"txid": t["hash"], "confirmations": t.get("confirmations", 0),
+                                  "height": h if h > 0 else None,
+                                  "sat": sum(o.get("value", 0) for o in t.get("outputs", [])
+                                             if addr in (o.get("addresses") or []))}
+            hs = [t["block_height"] for t in d.get("txs", []) if t.get("block_height", -1) > 0]
+            if since is None or not d.get("hasMore"): break
+            # before is exclusive: repeat the lowest height so a block split across pages isn't lost.
+            # BlockCypher can't page inside one block, so a page that doesn't get past it is an error
+            # rather than a silent gap (the caller keeps its cursor and retries next scan).
+            if not hs or params.get("before") == min(hs) + 1:
+                raise ChainError(f"{self.name}: more than {limit} txs for {addr[:12]}… at one height")
+            params["before"] = min(hs) + 1
+        return list(out.values())
+
+    async def balance(self, addr):
+        d = await self._get(f"/addrs/{addr}/balance")
+        return d.get("balance", 0), d.get("unconfirmed_balance", 0)
+
+    async def confirmations(self, txids):
+        """One batched /txs/a;b;c request per CONF_BATCH txids."""
+        out = {}
+        for i in range(0, len(txids), CONF_BATCH):
+            try: d = await self._get("/txs/" + ";".join(txids[i:i + CONF_BATCH]))
+            except ChainMissing: continue  # a lone txid BlockCypher no longer knows
+            for t in d if isinstance(d, list) else [d]:
+                if t.get("hash"): out[t["hash"]] = t.get("confirmations", 0)
+        return out
+
+    async def aclose(self):
+        if self.client: await self.client.aclose(); self.client = None
+
+class FakeChain:
+    """SQLite-backed stand-in. Rows of chain_txs(txid, addr, sat, at, confirmations)
+    become visible `at` seconds after the provider starts and gain a confirmation
+    every block_time seconds after that, so a prepared file replays as a stream."""
+    name = "fake"
+
+    def __init__(self, path, block_time=150):
+        self.db = sqlite3.connect(path, check_same_thread=False); self.lock = Lock()
+        self.block_time, self.t0 = block_time, time.time()
+        self.db.execute("CREATE TABLE IF NOT EXISTS chain_txs(txid TEXT PRIMARY KEY, addr TEXT NOT NULL, "
+                        "sat INTEGER NOT NULL, at REAL DEFAULT 0, confirmations INTEGER DEFAULT 0)")
+
+    def _rows(self, sql, p):
+        """Visible txs; heights count up from 1000 at one block per block_time."""
+        with self.lock:
+            el = time.time() - self.t0; tip = 1000 + int(el // self.block_time); out = []
+            for txid, sat, at, c in self.db.execute(sql, p):
+                if at > el: continue
+                c += int((el - at) // self.block_time)
+                out.append({"txid": txid, "sat": sat, "confirmations": c, "height": tip - c + 1 if c > 0 else None})
+            return out
+
+    def add(self, addr, sat, txid=None, at=None, confirmations=0):
+        """Queue a synthetic payment; at defaults to now."""
+        txid = txid or uuid4().hex
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO chain_txs VALUES(?,?,?,?,?)",
+                            (txid, addr, int(sat), time.time() - self.t0 if at is None else at, confirmations))
+            self.db.commit()
+        return txid
+
+    async def address_txs(self, addr, since=None, limit=50):
+        rows = await asyncio.to_thread(self._rows,
+            "SELECT txid,sat,at,confirmations FROM chain_txs WHERE addr=? ORDER BY at DESC", (addr,))
+        if since is None: return rows[:limit]
+        return [r for r in rows if r["height"] is None or r["height"] > since]
+
+    async def balance(self, addr):
+        rows = await asyncio.to_thread(self._rows, "SELECT txid,sat,at,confirmations FROM chain_txs WHERE addr=?", (addr,))
+        return (sum(r["sat"] for r in rows if r["confirmations"] > 0),
+                sum(r["sat"] for r in rows if r["confirmations"] <= 0))
+
+    async def confirmations(self, txids):
+        rows = await asyncio.to_thread(self._rows, "SELECT txid,sat,at,confirmations FROM chain_txs WHERE txid IN (" +
+                                       ",".join("?" * len(txids)) + ")", tuple(txids))
+        return {r["txid"]: r["confirmations"] for r in rows}
+
+    async def aclose(self):
+        with self.lock: self.db.close()
+
+CHAIN = FakeChain(CHAIN_FAKE) if CHAIN_FAKE else BlockCypher(os.getenv("BLOCKCYPHER_TOKEN"))
+
+def scan_cursor(addr):
+    r = q1("SELECT height FROM chain_cursors WHERE addr=?", (addr,))
+    return r["height"] if r else None
+
+def set_scan_cursor(addr, height):
+    qx("INSERT INTO chain_cursors(addr,height) VALUES(?,?) ON CONFLICT(addr) DO UPDATE "
+       "SET height=GREATEST(chain_cursors.height,EXCLUDED.height),updated_at=NOW()", (addr, height))
 
 def is_open(cutoff=11):    return True  # Always open
 def open_badge(cutoff=11):
@@ -417,18 +913,18 @@ def gdisc(code, vid=1):
         return None
     return r["pct"]
 
-def use_disc(code):
-    qx("UPDATE discount_codes SET uses=uses+1 WHERE code=?", (code.upper(),))
+def use_disc(code, t=None):
+    (t or AUTO).qx("UPDATE discount_codes SET uses=uses+1 WHERE code=?", (code.upper(),))
 
-def get_loyalty(uid):
-    return q1("SELECT points,credit,lifetime FROM loyalty WHERE user_id=?", (uid,)) or \
+def get_loyalty(uid, t=None):
+    return (t or AUTO).q1("SELECT points,credit,lifetime FROM loyalty WHERE user_id=?", (uid,)) or \
            {"points": 0, "credit": 0.0, "lifetime": 0}
 
-def add_points(uid, gbp):
-    pts = 25; lo = get_loyalty(uid)
+def add_points(uid, gbp, t=None):
+    pts = 25; lo = get_loyalty(uid, t)
     np = lo["points"] + pts; lf = lo["lifetime"] + pts
     m = np // 500; cr = m * 50.0; np = np % 500
-    qx("INSERT INTO loyalty(user_id,points,credit,lifetime) VALUES(?,?,?,?) "
+    (t or AUTO).qx("INSERT INTO loyalty(user_id,points,credit,lifetime) VALUES(?,?,?,?) "
        "ON CONFLICT(user_id) DO UPDATE SET points=?,credit=credit+?,lifetime=?",
        (uid, np, cr, lf, np, cr, lf))
     return pts, cr
@@ -452,16 +948,16 @@ def fmt_chat(oid):
         ("<b>👤 You</b>" if m["sender"] == "user" else "<b>🏪 Vendor</b>") +
         f" <i>{str(m['created_at'])[:16]}</i>\n{hl.escape(dec(m['message']))}" for m in msgs)
 
-def add_timeline(oid, event):
-    qx("INSERT INTO order_timeline(order_id,event) VALUES(?,?)", (oid, event))
+def add_timeline(oid, event, t=None):
+    (t or AUTO).qx("INSERT INTO order_timeline(order_id,event) VALUES(?,?)", (oid, event))
 
 def purge():
-    c = (datetime.now() - timedelta(days=30)).isoformat()
+    cd = datetime.now() - timedelta(days=30); c = cd.isoformat()
     qx("DELETE FROM drop_chats WHERE created_at<?", (c,))
-    qx("DELETE FROM cart WHERE created_at<?", (c,))
+    qx("DELETE FROM cart WHERE created_at<?", (c,)); CART.purge(cd)
 
-def credit_vendor_balance(vid, amount):
-    qx("INSERT INTO vendor_balances(vendor_id,owed) VALUES(?,?) "
+def credit_vendor_balance(vid, amount, t=None):
+    (t or AUTO).qx("INSERT INTO vendor_balances(vendor_id,owed) VALUES(?,?) "
        "ON CONFLICT(vendor_id) DO UPDATE SET owed=owed+?", (vid, amount, amount))
 
 def get_vendor_balance(vid):
@@ -475,27 +971,426 @@ def vip_label(uid):
         if tier == n: return f" {em} {n}"
     return ""
 
-def update_vip_tier(uid):
-    spend = (q1("SELECT COALESCE(SUM(gbp),0) as s FROM orders WHERE user_id=? AND status IN ('Paid','Dispatched')",
-                (uid,)) or {"s": 0})["s"]
+def update_vip_tier(uid, t=None):
+    x = t or AUTO
+    spend = (x.q1("SELECT COALESCE(SUM(gbp),0) as s FROM orders WHERE user_id=? AND status IN ('Paid','Dispatched')",
+                  (uid,)) or {"s": 0})["s"]
     new_tier = "standard"
     for n, em, thresh in VIP_LEVELS:
         if spend >= thresh: new_tier = n; break
-    old = (q1("SELECT vip_tier FROM users WHERE user_id=?", (uid,)) or {}).get("vip_tier", "standard")
+    old = (x.q1("SELECT vip_tier FROM users WHERE user_id=?", (uid,)) or {}).get("vip_tier", "standard")
     if new_tier != old:
-        qx("UPDATE users SET vip_tier=? WHERE user_id=?", (new_tier, uid)); return new_tier
+        x.qx("UPDATE users SET vip_tier=? WHERE user_id=?", (new_tier, uid)); return new_tier
     return None
 
+def mark_paid(t, oid, event):
+    """Flip an order to Paid inside the caller's tx(): turn its stock holds into
+    sold stock and apply vendor balance, loyalty and VIP side effects.
+    Returns (order, pts, credit, new_tier), or None if the order was no longer
+    Pending (already confirmed, rejected or expired). Callers run paid_sync() after commit."""
+    r = t.q1("UPDATE orders SET status='Paid' WHERE id=? AND status='Pending' "
+             "RETURNING user_id,ship,gbp,vendor_id,vendor_gbp", (oid,))
+    if not r: return None
+    add_timeline(oid, event, t)
+    # Held units become sold units
+    t.qx("UPDATE products p SET stock=GREATEST(p.stock-h.n,0) FROM "
+         "(SELECT product_id,SUM(n) as n FROM stock_holds WHERE order_id=? GROUP BY product_id) h "
+         "WHERE p.id=h.product_id AND p.stock<>-1", (oid,))
+    release_order(oid, t)
+    credit_vendor_balance(r["vendor_id"], r.get("vendor_gbp") or 0, t)
+    pts, cr = add_points(r["user_id"], r.get("gbp", 0), t)
+    return r, pts, cr, update_vip_tier(r["user_id"], t)
+
+def paid_sync(paid):
+    """Refresh in-memory stock views once a mark_paid() transaction has committed."""
+    if paid: bump_catalogue(paid[0]["vendor_id"])
+    return paid
+
 def flash_pct(pid):
-    r = q1("SELECT pct,expires FROM flash_sales WHERE product_id=? AND active=1", (pid,))
+    r = catalogue_root()["flash"].get(pid)
     if not r: return None
     if r.get("expires"):
         try:
-            if datetime.fromisoformat(r["expires"]) < datetime.now():
-                qx("UPDATE flash_sales SET active=0 WHERE product_id=?", (pid,)); return None
+            exp = r["expires"] if isinstance(r["expires"], datetime) else datetime.fromisoformat(r["expires"])
+            if exp < datetime.now():
+                qx("UPDATE flash_sales SET active=0 WHERE product_id=?", (pid,)); bump_catalogue(); return None
         except: pass
     return r["pct"]
 
+# ── CATALOGUE CACHE ────────────────────────────────────────────────────────────
+# Browse screens read vendors/categories/products from memory. Admin mutators call
+# bump_catalogue() to reload everything; checkout bumps just the vendor it sold from.
+_CAT_VER, _VEND_VER = 0, {}
+_CAT_ROOT = {"ver": -1}
+_CAT_VEND = {}  # vid -> snapshot
+
+def bump_catalogue(vid=None):
+    global _CAT_VER
+    if vid is None: _CAT_VER += 1
+    else: _VEND_VER[vid] = _VEND_VER.get(vid, 0) + 1
+
+def catalogue_root():
+    """Active vendors plus the category/product → vendor index."""
+    global _CAT_ROOT
+    if _CAT_ROOT["ver"] == _CAT_VER: return _CAT_ROOT
+    ver = _CAT_VER
+    _CAT_ROOT = {"ver": ver, "render": {},
+                 "vendors":  qa("SELECT * FROM vendors WHERE active=1 ORDER BY id"),
+                 "cat_vid":  {r["id"]: r["vendor_id"] for r in qa("SELECT id,vendor_id FROM categories")},
+                 "prod_vid": {r["id"]: r["vendor_id"] for r in qa("SELECT id,vendor_id FROM products WHERE hidden=0")},
+                 "flash":    {r["product_id"]: r for r in qa("SELECT product_id,pct,expires FROM flash_sales WHERE active=1")}}
+    return _CAT_ROOT
+
+def catalogue(vid):
+    """One vendor's snapshot: vendor row (None if inactive), categories and visible products."""
+    ver = (_CAT_VER, _VEND_VER.get(vid, 0))
+    snap = _CAT_VEND.get(vid)
+    if snap and snap["ver"] == ver: return snap
+    root = catalogue_root()
+    cats  = qa("SELECT * FROM categories WHERE vendor_id=? ORDER BY id", (vid,))
+    prods = qa("SELECT * FROM products WHERE hidden=0 AND vendor_id=? ORDER BY id", (vid,))
+    snap = {"ver": ver, "render": {}, "vendor": next((v for v in root["vendors"] if v["id"] == vid), None),
+            "cats": cats, "cat": {c["id"]: c for c in cats},
+            "prods": prods, "prod": {p["id"]: p for p in prods}}
+    _CAT_VEND[vid] = snap
+    return snap
+
+def rendered(snap, key, build):
+    """Memoise a finished screen (text, markup, …) on the snapshot it was built from,
+    so it is thrown away with that snapshot on the next bump_catalogue()."""
+    r = snap["render"]
+    if key not in r: r[key] = build()
+    return r[key]
+
+# ── PRICING ────────────────────────────────────────────────────────────────────
+# quote() is pure: basket lines plus a policy snapshot in, itemised totals out.
+# Every checkout screen and co_confirm price through it, so the total shown is
+# the total charged. A vendor's policy is rebuilt only when settings or its
+# catalogue snapshot move on. Basket lines hold list prices; flash sales are
+# applied here, not baked in when the line is added.
+_POLICY = {}  # vid -> policy
+
+def pricing_policy(vid):
+    ver = (_SETTINGS_VER, _CAT_VER, _VEND_VER.get(vid, 0))
+    p = _POLICY.get(vid)
+    if p and p["ver"] == ver: return p
+    cv = catalogue(vid); flash = {}
+    for pid, r in catalogue_root()["flash"].items():
+        if pid not in cv["prod"]: continue
+        exp = r.get("expires")
+        if exp and not isinstance(exp, datetime):
+            try: exp = datetime.fromisoformat(exp)
+            except ValueError: exp = None
+        flash[pid] = (r["pct"], exp)
+    p = {"ver": ver, "vendor": cv["vendor"], "ship": SHIP, "flash": flash,
+         "bulk_thresh": float(gs("bulk_threshold", "100")), "bulk_pct": float(gs("bulk_pct", "5")),
+         "commission": (cv["vendor"] or {}).get("commission_pct", 10) / 100,
+         "tiers": {pid: json.loads(r["tiers"]) if r.get("tiers") else TIERS for pid, r in cv["prod"].items()}}
+    _POLICY[vid] = p
+    return p
+
+def flash_price(t, m, fp):
+    """m of tier t under flash discount fp, rounded per tier and then multiplied
+    as flash_tiers() and the product stepper show it."""
+    return round(round(t["price"] * (1 - fp), 2) * m, 2)
+
+def list_price(tiers, qty, price, fp=None):
+    """(list price, tier, multiple) for qty as a whole multiple of one tier, matched
+    against the price the customer was shown (list, or flash-discounted by fp).
+    None if nothing fits."""
+    for t in tiers:
+        m = qty / t["qty"]
+        if m < 1 or abs(m - round(m)) > 1e-9: continue
+        m = round(m); lp = round(t["price"] * m, 2)
+        if abs(lp - price) < 0.005 or (fp and abs(flash_price(t, m, fp) - price) < 0.005): return lp, t, m
+    return None
+
+def quote(items, policy, ship=None, disc_pct=0, now=None):
+    """Itemised price of basket lines under policy. Flash sales only discount
+    tier-priced lines, so bundle lines keep their bundle price."""
+    now = now or datetime.now(); lines = []
+    for r in items:
+        f = policy["flash"].get(r["product_id"]); off = 0
+        hit = f and (not f[1] or f[1] >= now) and \
+              list_price(policy["tiers"].get(r["product_id"], TIERS), r["qty"], r["price"])
+        if hit: lp, t, m = hit; off = round(lp - flash_price(t, m, f[0]), 2)
+        lines.append({"name": r["name"], "qty": r["qty"], "price": r["price"], "flash": off})
+    sub   = round(sum(l["price"] for l in lines), 2)
+    flash = round(sum(l["flash"] for l in lines), 2)
+    disc  = round((sub - flash) * disc_pct, 2)
+    net   = round(sub - flash - disc, 2)
+    bulk  = round(net * policy["bulk_pct"] / 100, 2) if net >= policy["bulk_thresh"] else 0
+    sp    = policy["ship"][ship]["price"] if ship else 0
+    total = round(net - bulk + sp, 2)
+    platform = round(total * policy["commission"], 2)
+    return {"ver": policy["ver"], "lines": lines, "sub": sub, "flash": flash, "disc": disc,
+            "bulk": bulk, "ship": sp, "total": total,
+            "platform": platform, "vendor": round(total - platform, 2)}
+
+# ── SEARCH ─────────────────────────────────────────────────────────────────────
+SEARCH_PP = 8
+INLINE_PP = 20   # results per inline-mode page
+INLINE_CACHE = int(os.getenv("INLINE_CACHE", "60"))  # seconds Telegram may cache an inline answer (per user)
+
+def _words(s): return re.findall(r"\w+", (s or "").lower())
+def _grams(w): w = f" {w} "; return {w[i:i+3] for i in range(len(w) - 2)}
+
+class _SearchIndex:
+    """Inverted index over visible products (word → {pid: weight}, name words
+    outweigh description words) with a trigram map for typo tolerance."""
+    def __init__(self, ver, rows):
+        self.ver, self.docs, self.post, self.grams = ver, {r["id"]: r for r in rows}, {}, {}
+        for r in rows:
+            for w in _words(r["description"]): self.post.setdefault(w, {})[r["id"]] = 1
+            for w in _words(r["name"]):        self.post.setdefault(w, {})[r["id"]] = 3
+        self.vocab = sorted(self.post)
+        for w in self.vocab:
+            for g in _grams(w): self.grams.setdefault(g, set()).add(w)
+
+    def _expand(self, term):
+        """Index words matching term → similarity: exact 1, prefix .8, trigram below that."""
+        out = {term: 1.0} if term in self.post else {}
+        i = bisect_left(self.vocab, term)
+        while i < len(self.vocab) and self.vocab[i].startswith(term):
+            out.setdefault(self.vocab[i], 0.8); i += 1
+        if len(term) >= 3:
+            tg = _grams(term); shared = {}
+            for g in tg:
+                for w in self.grams.get(g, ()): shared[w] = shared.get(w, 0) + 1
+            for w, n in shared.items():
+                sim = n / (len(tg) + len(_grams(w)) - n)
+                if sim >= 0.25: out.setdefault(w, 0.7 * sim)
+        return out
+
+    def search(self, query):
+        """Product ids matching every query word, best first."""
+        scores = None
+        for t in _words(query):
+            hit = {}
+            for w, sim in self._expand(t).items():
+                for pid, wt in self.post[w].items(): hit[pid] = max(hit.get(pid, 0), sim * wt)
+            scores = hit if scores is None else {p: sc + hit[p] for p, sc in scores.items() if p in hit}
+            if not scores: return []
+        return sorted(scores or (), key=lambda p: (-scores[p], self.docs[p]["name"].lower()))
+
+_SEARCH = None
+
+def search_index():
+    """Current index, rebuilt when the catalogue version moves."""
+    global _SEARCH
+    if _SEARCH and _SEARCH.ver == _CAT_VER: return _SEARCH
+    ver = _CAT_VER
+    rows = qa("SELECT p.id,p.name,p.description,p.tiers,p.vendor_id,v.name as vname,v.emoji as vemoji "
+              "FROM products p LEFT JOIN vendors v ON v.id=p.vendor_id WHERE p.hidden=0")
+    for r in rows: r["tiers"] = json.loads(r["tiers"]) if r.get("tiers") else TIERS[:]
+    _SEARCH = _SearchIndex(ver, rows)
+    return _SEARCH
+
+def search_page(query, page=0):
+    """(text, markup) for one page of results, or None when nothing matches."""
+    ix = search_index(); ids = ix.search(query)
+    if not ids: return None
+    pages = (len(ids) - 1) // SEARCH_PP; page = min(max(page, 0), pages)
+    kb = [[IB(f"🌿 {ix.docs[p]['name']}", f"prod_{p}")] for p in ids[page*SEARCH_PP:(page+1)*SEARCH_PP]]
+    nav = ([IB("◀️", f"srch_{page-1}")] if page > 0 else []) + \
+          ([IB("▶️", f"srch_{page+1}")] if page < pages else [])
+    return (f"🔍 <b>{len(ids)} results for '{hl.escape(query)}'</b>",
+            InlineKeyboardMarkup(kb + ([nav] if nav else []) + [[IB("⬅️ Back", "menu")]]))
+
+def inline_results(query, offset, link):
+    """One page of inline-mode articles plus the next offset ("" when done)."""
+    ix = search_index(); ids = ix.search(query)
+    out = []
+    for pid in ids[offset:offset + INLINE_PP]:
+        r = ix.docs[pid]; fp = flash_pct(pid)
+        tiers = flash_tiers(r["tiers"], fp) if fp else r["tiers"]
+        vtxt = f"{r['vemoji']} {r['vname']}" if r["vname"] else ""
+        out.append(InlineQueryResultArticle(
+            id=str(pid), title=("🔥 " if fp else "🌿 ") + r["name"],
+            description=" · ".join(x for x in (vtxt, ft(tiers[0]) if tiers else "") if x),
+            input_message_content=InputTextMessageContent(
+                f"🌿 <b>{hl.escape(r['name'])}</b>" + (f"\n{hl.escape(vtxt)}" if vtxt else "") +
+                "\n\n" + "".join(ft(t) + "\n" for t in tiers), parse_mode="HTML"),
+            reply_markup=InlineKeyboardMarkup([[_IB(text="🛍️ View in shop", url=f"{link}prod_{pid}")]])))
+    return out, (str(offset + INLINE_PP) if offset + INLINE_PP < len(ids) else "")
+
+# ── VIEW COUNTERS ──────────────────────────────────────────────────────────────
+# show_product bumps an in-memory delta; flush_views() writes them all in one UPDATE.
+_VIEWS, _VIEWS_LOCK = {}, Lock()
+
+def count_view(pid):
+    with _VIEWS_LOCK: _VIEWS[pid] = _VIEWS.get(pid, 0) + 1
+
+def _views_values(batch):
+    return ",".join(["(?,?)"] * len(batch)), [x for kv in batch.items() for x in kv]
+
+def flush_views():
+    with _VIEWS_LOCK: batch = dict(_VIEWS); _VIEWS.clear()
+    if not batch: return 0
+    vals, params = _views_values(batch)
+    try:
+        qx(f"UPDATE products p SET views=COALESCE(p.views,0)+v.n FROM (VALUES {vals}) AS v(id,n) WHERE p.id=v.id", params)
+    except Exception:
+        with _VIEWS_LOCK:
+            for k, n in batch.items(): _VIEWS[k] = _VIEWS.get(k, 0) + n
+        raise
+    return len(batch)
+
+def top_products(vid=None, n=10):
+    """Most viewed products, counting deltas not yet flushed."""
+    with _VIEWS_LOCK: batch = dict(_VIEWS)
+    where = "WHERE p.vendor_id=? " if vid else ""
+    if not batch:
+        return qa(f"SELECT p.name,COALESCE(p.views,0) as views FROM products p {where}ORDER BY views DESC LIMIT ?",
+                  ((vid,) if vid else ()) + (n,))
+    vals, params = _views_values(batch)
+    return qa(f"SELECT p.name,COALESCE(p.views,0)+COALESCE(v.n,0) as views FROM products p "
+              f"LEFT JOIN (VALUES {vals}) AS v(id,n) ON v.id=p.id {where}ORDER BY views DESC LIMIT ?",
+              tuple(params) + ((vid,) if vid else ()) + (n,))
+
+# ── BASKETS ────────────────────────────────────────────────────────────────────
+class _Carts:
+    """Baskets held in memory and written behind to the cart table, which stays
+    the source of truth across restarts. A basket loads on first touch; flush()
+    rewrites every changed basket in one transaction. Flushes run one at a time,
+    so an older snapshot can never commit over a newer one."""
+    def __init__(self):
+        self._c, self._dirty, self._used, self._lock = {}, set(), {}, Lock()
+        self._flush_lock = Lock()
+
+    def _get(self, uid):
+        with self._lock:
+            if uid in self._c: self._used[uid] = time.time(); return self._c[uid]
+        rows = qa("SELECT cart.id,cart.product_id,cart.vendor_id,cart.qty,cart.price,cart.created_at,products.name "
+                  "FROM cart JOIN products ON cart.product_id=products.id WHERE cart.user_id=? ORDER BY cart.id", (uid,))
+        with self._lock:
+            self._used[uid] = time.time()
+            return self._c.setdefault(uid, rows)
+
+    def items(self, uid, vid=None):
+        """Lines for products still listed; deleted or hidden products drop out."""
+        lines = self._get(uid); listed = catalogue_root()["prod_vid"]
+        with self._lock: return [dict(l) for l in lines
+                                 if (vid is None or l["vendor_id"] == vid) and l["product_id"] in listed]
+
+    def add(self, uid, pid, vid, qty, price, name):
+        lines = self._get(uid)
+        with self._lock:
+            lines.append({"id": max((l["id"] for l in lines), default=0) + 1, "product_id": pid, "vendor_id": vid,
+                          "qty": qty, "price": price, "created_at": datetime.now(), "name": name})
+            self._dirty.add(uid)
+
+    def remove(self, uid, line_id):
+        lines = self._get(uid)
+        with self._lock: lines[:] = [l for l in lines if l["id"] != line_id]; self._dirty.add(uid)
+
+    def clear(self, uid, vid=None):
+        lines = self._get(uid)
+        with self._lock: lines[:] = [l for l in lines if vid is not None and l["vendor_id"] != vid]; self._dirty.add(uid)
+
+    def flush(self, uids=None):
+        with self._flush_lock:
+            with self._lock:
+                todo = self._dirty if uids is None else self._dirty & set(uids)
+                self._dirty = self._dirty - todo
+                rows = [(uid, l["product_id"], l["vendor_id"], l["qty"], l["price"], l["created_at"])
+                        for uid in todo for l in self._c.get(uid, ())]
+            if not todo: return 0
+            try:
+                with tx() as t:
+                    t.qx("DELETE FROM cart WHERE user_id = ANY(?)", (list(todo),))
+                    if rows:
+                        t.qx("INSERT INTO cart(user_id,product_id,vendor_id,qty,price,created_at) VALUES " +
+                             ",".join(["(?,?,?,?,?,?)"] * len(rows)), [x for r in rows for x in r])
+            except Exception:
+                with self._lock: self._dirty |= todo
+                raise
+            return len(todo)
+
+    def purge(self, cutoff):
+        """Drop lines older than cutoff (purge() deletes them from the table)."""
+        with self._lock:
+            for lines in self._c.values():
+                lines[:] = [l for l in lines if l["created_at"] >= cutoff]
+
+    def reap(self, idle=CART_IDLE):
+        cutoff = time.time() - idle
+        with self._lock:
+            for uid in [u for u, ts in self._used.items() if ts < cutoff and u not in self._dirty]:
+                self._c.pop(uid, None); self._used.pop(uid, None)
+
+CART = _Carts()
+
+# ── STOCK HOLDS ────────────────────────────────────────────────────────────────
+# products.stock only drops when an order is paid. Until then the units sit in
+# stock_holds: a checkout hold (HOLD_TTL) becomes an order hold at co_confirm and
+# is released by reject/expiry. Units are grams, like products.stock. _HELD
+# mirrors the stock_holds rows per product (and _MINE each user's checkout hold)
+# so available() needs no query; every insert/delete passes its rows to
+# held_moved(), which applies them once the transaction commits.
+_HELD, _MINE, _HELD_LOCK = {}, {}, Lock()  # pid -> units; uid -> {pid: units}
+_HOLD_COLS = "product_id,user_id,order_id,n"
+
+def _held_apply(rows, sign):
+    with _HELD_LOCK:
+        for r in rows:
+            pid, n = r["product_id"], sign * r["n"]
+            _HELD[pid] = _HELD.get(pid, 0) + n
+            if r["order_id"] is None:
+                mine = _MINE.setdefault(r["user_id"], {}); mine[pid] = mine.get(pid, 0) + n
+                if mine[pid] <= 0: del mine[pid]
+                if not mine: del _MINE[r["user_id"]]
+
+def held_moved(t, rows, sign):
+    """Count rows (+1 inserted, -1 deleted) into _HELD after t commits."""
+    if rows: t.after.append(lambda: _held_apply(rows, sign))
+
+def held_reload():
+    """Full load at startup; afterwards _HELD only moves by held_moved() deltas."""
+    global _HELD, _MINE
+    with _HELD_LOCK: _HELD, _MINE = {}, {}
+    _held_apply(qa(f"SELECT {_HOLD_COLS} FROM stock_holds"), 1)
+
+def available(pid, stock, uid=None):
+    """Units left once holds are taken off; -1 stays unlimited. uid's own
+    checkout hold is not counted against them, as reserve() doesn't."""
+    if stock == -1: return stock
+    return max(stock - _HELD.get(pid, 0) + _MINE.get(uid, {}).get(pid, 0), 0)
+
+def basket_need(items):
+    """Grams per product, rounded up to whole stock units."""
+    need = {}
+    for r in items: need[r["product_id"]] = need.get(r["product_id"], 0) + r["qty"]
+    return {pid: math.ceil(n - 1e-9) for pid, n in need.items()}
+
+def reserve(t, uid, need, order_id, ttl):
+    """Swap uid's checkout holds for holds on need ({pid: units}) inside tx t.
+    Per-product advisory locks serialise competing reservations without
+    locking products rows. Raises OutOfStock if any product can't cover it."""
+    t.q1("SELECT COUNT(pg_advisory_xact_lock(id)) FROM (SELECT unnest(?::int[]) AS id ORDER BY 1) l",
+         (sorted(need),))
+    short = t.qa("WITH need(id,n) AS (VALUES " + ",".join(["(?::int,?::int)"] * len(need)) + ") "
+                 "SELECT p.name,p.stock-COALESCE(h.s,0) as left FROM need JOIN products p ON p.id=need.id "
+                 "LEFT JOIN LATERAL (SELECT SUM(n) as s FROM stock_holds WHERE product_id=p.id AND expires>NOW() "
+                 "AND NOT (user_id=? AND order_id IS NULL)) h ON TRUE "
+                 "WHERE p.stock<>-1 AND p.stock-COALESCE(h.s,0)<need.n",
+                 [x for kv in need.items() for x in kv] + [uid])
+    if short: raise OutOfStock([(r["name"], max(r["left"], 0)) for r in short])
+    held_moved(t, t.qa(f"DELETE FROM stock_holds WHERE user_id=? AND order_id IS NULL RETURNING {_HOLD_COLS}",
+                       (uid,)), -1)
+    held_moved(t, t.qa("INSERT INTO stock_holds(product_id,user_id,order_id,n,expires) VALUES " +
+                       ",".join(["(?,?,?,?,NOW()+?*INTERVAL '1 second')"] * len(need)) + f" RETURNING {_HOLD_COLS}",
+                       [x for pid, n in need.items() for x in (pid, uid, order_id, n, ttl)]), 1)
+
+def hold_basket(uid, items):
+    """Checkout hold on the basket; raises OutOfStock."""
+    with tx() as t: reserve(t, uid, basket_need(items), None, HOLD_TTL)
+
+def release_order(oid, t=None):
+    if t is None:
+        with tx() as t: return release_order(oid, t)
+    held_moved(t, t.qa(f"DELETE FROM stock_holds WHERE order_id=? RETURNING {_HOLD_COLS}", (oid,)), -1)
+
 # ── INVOICE BUILDER ────────────────────────────────────────────────────────────
 def build_invoice(order_id):
     o = q1("SELECT * FROM orders WHERE id=?", (order_id,))
@@ -578,25 +1473,31 @@ def co_kb(ud):
     rows.append([IB("❌ Cancel", "menu")])
     return InlineKeyboardMarkup(rows)
 
-def co_summary(ud, uid=None):
-    s = ud.get("co_ship"); sub = ud.get("co_sub", 0); dp = ud.get("co_disc_pct", 0)
-    sp = SHIP[s]["price"] if s else 0; sl = SHIP[s]["label"] if s else "—"
-    disc = round(sub * dp, 2)
-    bulk_thresh = float(gs("bulk_threshold", "100"))
-    bulk_pct    = float(gs("bulk_pct", "5"))
-    bulk_disc   = round((sub - disc) * bulk_pct / 100, 2) if (sub - disc) >= bulk_thresh else 0
-    total = round(sub - disc - bulk_disc + sp, 2)
+def checkout_quote(ud, uid):
+    """(basket lines, policy, quote) for the vendor being checked out."""
+    vid = ud.get("co_vid", 1)
+    items = CART.items(uid, vid); policy = pricing_policy(vid)
+    return items, policy, quote(items, policy, ud.get("co_ship"), ud.get("co_disc_pct", 0))
+
+def co_summary(ud, uid):
+    """Checkout screen text and total; the total is remembered so co_confirm
+    can refuse to charge anything else."""
+    s = ud.get("co_ship"); sl = SHIP[s]["label"] if s else "—"
+    qt = checkout_quote(ud, uid)[2]; ud["co_total"] = qt["total"]
     addr = ud.get("co_addr") or ("Not required" if s == "drop" else "—")
-    dl = (f"🏷️ {ud.get('co_disc_code', '')} -£{disc:.2f}\n") if dp else ""
-    bl = f"📦 Bulk deal -£{bulk_disc:.2f}\n" if bulk_disc else ""
+    il = "".join(f"• {hl.escape(l['name'])} {fq(l['qty'])} — £{l['price']:.2f}\n" for l in qt["lines"])
+    fl = f"🔥 Flash sale -£{qt['flash']:.2f}\n" if qt["flash"] else ""
+    dl = (f"🏷️ {ud.get('co_disc_code', '')} -£{qt['disc']:.2f}\n") if qt["disc"] else ""
+    bl = f"📦 Bulk deal -£{qt['bulk']:.2f}\n" if qt["bulk"] else ""
+    shl = f"🚚 Delivery £{qt['ship']:.2f}\n" if qt["ship"] else ""
     nl = f"📝 Note: {ud.get('co_note', '')}\n" if ud.get("co_note") else ""
     hint = ("📍 <i>Local drop.</i>" if s == "drop" else
             "📦 <i>Enter address above.</i>" if s == "tracked24" else
             "<i>Select delivery method.</i>")
     return (f"🛒 <b>Checkout</b>\n━━━━━━━━━━━━━━━━━━━━\n"
             f"👤 {hl.escape(ud.get('co_name') or '—')}\n"
-            f"🏠 {hl.escape(addr)}\n🚚 {sl}\n{dl}{bl}{nl}"
-            f"━━━━━━━━━━━━━━━━━━━━\n💰 <b>Total: £{total:.2f}</b>\n\n{hint}"), total
+            f"🏠 {hl.escape(addr)}\n🚚 {sl}\n━━━━━━━━━━━━━━━━━━━━\n{il}{fl}{dl}{bl}{shl}{nl}"
+            f"━━━━━━━━━━━━━━━━━━━━\n💰 <b>Total: £{qt['total']:.2f}</b>\n\n{hint}"), qt["total"]
 
 def dc_user_kb(oid, closed=False):
     return KM([IB("🔓 Reopen Chat", f"dco_{oid}")], [IB("⬅️ Back", "orders")]) if closed \
@@ -616,41 +1517,46 @@ async def safe_edit(q, text, **kw):
 # USER HANDLERS
 # ══════════════════════════════════════════════════════════════════════════════
 async def cmd_start(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    purge(); uid = u.effective_user.id
-    if is_banned(uid): await u.message.reply_text("🚫 You are banned."); return
-    is_new = not q1("SELECT 1 FROM users WHERE user_id=?", (uid,))
-    qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
-       (uid, u.effective_user.username or ""))
-    if is_new and ctx.args:
-        r_ = credit_ref(ctx.args[0], uid)
+    await arun(purge); uid = u.effective_user.id
+    if await arun(is_banned, uid): await u.message.reply_text("🚫 You are banned."); return
+    is_new = not await aq1("SELECT 1 FROM users WHERE user_id=?", (uid,))
+    await aqx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
+              (uid, u.effective_user.username or ""))
+    if is_new: forget_principal(uid)
+    deep = ctx.args[0] if ctx.args else ""
+    if is_new and deep and not deep.startswith("prod_"):
+        r_ = await arun(credit_ref, deep, uid)
         if r_:
             owner, cnt = r_
             try:
                 rthresh = int(gs("ref_reward_orders","15"))
                 rmsg = gs("ref_reward_msg","🎉 Referral reward!")
                 msg_out = rmsg if cnt % rthresh == 0 else f"🔗 +1 ref · {cnt} total · {rthresh-(cnt%rthresh)} more for reward"
-                await ctx.bot.send_message(owner, msg_out)
+                OUTBOX.send(owner, msg_out, prio=P_MKT)
             except: pass
     name = hl.escape(u.effective_user.first_name or "there")
-    vip = vip_label(uid); extra = gs("home_extra"); el = f"\n\n{extra}" if extra else ""
+    vip = await arun(vip_label, uid); extra = await arun(gs, "home_extra"); el = f"\n\n{extra}" if extra else ""
     await u.message.reply_text(
         f"🔷 <b>Welcome, {name}{vip}!</b>\n━━━━━━━━━━━━━━━━━━━━\n\n"
         f"{open_badge()}\n🕙 <b>Mon–Sat · Comms close 11am</b>\n\n"
         f"Your trusted marketplace.{el}\n\n"
         f"🏪 Verified Vendors · 🔒 Discreet · ⭐ 5-Star\n\n👇 <b>Tap Browse Vendors</b>",
         parse_mode="HTML", reply_markup=menu())
+    if deep.startswith("prod_") and deep[5:].isdigit():
+        await send_product(ctx, u.effective_chat.id, uid, int(deep[5:]))
 
 async def show_vendors(u, ctx):
     q = u.callback_query
-    vs = qa("SELECT * FROM vendors WHERE active=1 ORDER BY id")
+    root = await arun(catalogue_root); vs = root["vendors"]
     if not vs: await safe_edit(q, "🏪 No vendors yet.", reply_markup=back_kb()); return
-    txt = ("🔷 <b>PhiVara Network</b>\n\nChoose a vendor:\n\n" +
-           "".join(f"{v['emoji']} <b>{hl.escape(v['name'])}</b>\n"
-                   f"<i>{hl.escape(v['description'])}</i>\n\n" for v in vs))
-    await safe_edit(q, txt, parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(
+    txt, kb = rendered(root, "vendors", lambda: (
+        "🔷 <b>PhiVara Network</b>\n\nChoose a vendor:\n\n" +
+        "".join(f"{v['emoji']} <b>{hl.escape(v['name'])}</b>\n"
+                f"<i>{hl.escape(v['description'])}</i>\n\n" for v in vs),
+        InlineKeyboardMarkup(
             [[IB(f"{v['emoji']} {v['name']}", f"vend_{v['id']}")] for v in vs] +
-            [[IB("⬅️ Back", "menu")]]))
+            [[IB("⬅️ Back", "menu")]])))
+    await safe_edit(q, txt, parse_mode="HTML", reply_markup=kb)
 
 def get_vendor_holiday(vid):
     """Returns holiday row if vendor is currently on holiday, else None."""
@@ -666,13 +1572,13 @@ def get_vendor_holiday(vid):
 async def show_vendor_about(u, ctx):
     """Vendor description/about page shown before browsing products."""
     q = u.callback_query; vid = int(q.data.split("_")[1])
-    v = q1("SELECT * FROM vendors WHERE id=? AND active=1", (vid,))
+    v = (await arun(catalogue, vid))["vendor"]
     if not v: await safe_edit(q, "❌ Vendor not found.", reply_markup=back_kb()); return
     cutoff = v.get("cutoff_hour", 11)
-    holiday = get_vendor_holiday(vid)
+    holiday = await arun(get_vendor_holiday, vid)
     badge = open_badge(cutoff)
     about = v.get("about","").strip() or v.get("description","").strip() or "No description yet."
-    rev = q1("SELECT AVG(stars) as a, COUNT(*) as c FROM reviews WHERE vendor_id=?", (vid,))
+    rev = await aq1("SELECT AVG(stars) as a, COUNT(*) as c FROM reviews WHERE vendor_id=?", (vid,))
     rating_txt = f"\n⭐ {rev['a']:.1f}/5 ({rev['c']} reviews)" if rev and rev.get("c",0) > 0 else ""
     holiday_banner = ""
     if holiday:
@@ -690,35 +1596,43 @@ async def show_vendor_about(u, ctx):
 
 async def show_vendor(u, ctx):
     q = u.callback_query; vid = int(q.data.split("_")[2] if "_browse_" in q.data else q.data.split("_")[1])
-    v = q1("SELECT * FROM vendors WHERE id=? AND active=1", (vid,))
+    cv = await arun(catalogue, vid); v = cv["vendor"]
     if not v: await safe_edit(q, "❌ Vendor not found.", reply_markup=back_kb()); return
-    cats = qa("SELECT * FROM categories WHERE vendor_id=? ORDER BY id", (vid,)); kb = []
-    featured = qa("SELECT id,name FROM products WHERE hidden=0 AND vendor_id=? AND featured=1 ORDER BY id", (vid,))
+    txt, kb = rendered(cv, "vendor", lambda: _render_vendor(cv))
+    await safe_edit(q, txt, parse_mode="HTML", reply_markup=kb)
+
+def _render_vendor(cv):
+    v = cv["vendor"]; vid = v["id"]; cats = cv["cats"]; kb = []
+    featured = [r for r in cv["prods"] if r["featured"] == 1]
     if featured: kb += [[IB(f"⭐ {r['name']}", f"prod_{r['id']}")] for r in featured]
     if cats:
         kb += [[IB(f"{c['emoji']} {c['name']}", f"cat_{c['id']}")] for c in cats]
-        unc = qa("SELECT id,name FROM products WHERE hidden=0 AND vendor_id=? AND featured=0 "
-                 "AND (category_id=0 OR category_id IS NULL) ORDER BY id", (vid,))
+        unc = [r for r in cv["prods"] if r["featured"] == 0 and not r["category_id"]]
         if unc: kb += [[IB(f"🌿 {r['name']}", f"prod_{r['id']}")] for r in unc]
     else:
-        prods = qa("SELECT id,name FROM products WHERE hidden=0 AND vendor_id=? AND featured=0 ORDER BY id", (vid,))
+        prods = [r for r in cv["prods"] if r["featured"] == 0]
         kb += [[IB(f"🌿 {r['name']}", f"prod_{r['id']}")] for r in prods] or [[IB("No products yet", "noop")]]
     kb += [[IB("⬅️ Back", f"vend_{vid}")]]
     desc = f"\n<i>{hl.escape(v['description'])}</i>" if v.get("description") else ""
-    await safe_edit(q, f"{v['emoji']} <b>{hl.escape(v['name'])}</b>{desc}",
-        parse_mode="HTML", reply_markup=InlineKeyboardMarkup(kb))
+    return f"{v['emoji']} <b>{hl.escape(v['name'])}</b>{desc}", InlineKeyboardMarkup(kb)
 
 async def show_category(u, ctx):
     q = u.callback_query; cid = int(q.data.split("_")[1])
-    cat = q1("SELECT * FROM categories WHERE id=?", (cid,))
-    if not cat: await safe_edit(q, "❌ Not found.", reply_markup=back_kb()); return
-    vid = cat.get("vendor_id", 1)
-    prods = qa("SELECT id,name,featured FROM products WHERE hidden=0 AND category_id=? ORDER BY featured DESC,id", (cid,))
+    def load():
+        vid = catalogue_root()["cat_vid"].get(cid)
+        return catalogue(vid) if vid is not None else None
+    cv = await arun(load)
+    if not cv or cid not in cv["cat"]: await safe_edit(q, "❌ Not found.", reply_markup=back_kb()); return
+    txt, kb = rendered(cv, ("cat", cid), lambda: _render_category(cv, cid))
+    await safe_edit(q, txt, parse_mode="HTML", reply_markup=kb)
+
+def _render_category(cv, cid):
+    cat = cv["cat"][cid]; vid = cat.get("vendor_id", 1)
+    prods = sorted((r for r in cv["prods"] if r["category_id"] == cid), key=lambda r: (-(r["featured"] or 0), r["id"]))
     kb = [[IB(("⭐ " if r.get("featured") else "🌿 ") + r["name"], f"prod_{r['id']}")] for r in prods] + \
          [[IB("⬅️ Back", f"vend_{vid}")]]
-    await safe_edit(q, f"{cat['emoji']} <b>{hl.escape(cat['name'])}</b>", parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(
-            kb if prods else [[IB("No products here", "noop")], [IB("⬅️ Back", f"vend_{vid}")]]))
+    return (f"{cat['emoji']} <b>{hl.escape(cat['name'])}</b>",
+            InlineKeyboardMarkup(kb if prods else [[IB("No products here", "noop")], [IB("⬅️ Back", f"vend_{vid}")]]))
 
 def _product_kb(pid, tiers, tier_idx, qty_mult, vid):
     """Build the +/- quantity selector keyboard for a product."""
@@ -753,57 +1667,103 @@ def _product_kb(pid, tiers, tier_idx, qty_mult, vid):
          [IB("⬅️ Back", f"vend_{vid}")]]
     )
 
+def product_view(pid):
+    """Overlay-free product screen pieces cached on the vendor snapshot, or None if not visible.
+    show_product patches flash pricing, stock and rating on top."""
+    vid = catalogue_root()["prod_vid"].get(pid)
+    if vid is None: return None
+    cv = catalogue(vid); row = cv["prod"].get(pid)
+    if not row: return None
+    def build():
+        tiers = json.loads(row["tiers"]) if row.get("tiers") else TIERS[:]
+        vid = row.get("vendor_id", 1)
+        return {"row": row, "vid": vid, "tiers": tiers,
+                "title": ("⭐ " if row.get("featured") else "🌿 ") + f"<b>{hl.escape(row['name'])}</b>",
+                "desc":  f"\n\n{hl.escape(row['description'] or '')}\n\n",
+                "tier_txt": "".join(ft(t) + "\n" for t in tiers),
+                "kb": _product_kb(pid, tiers, 0, 1, vid)}
+    return rendered(cv, ("prod", pid), build)
+
+def flash_tiers(tiers, fp):
+    return [dict(t, price=round(t["price"] * (1 - fp), 2)) for t in tiers]
+
+def product_tiers(pid, uid=None):
+    """(vid, tiers with any flash discount applied, stock available to uid) for
+    the +/- stepper, from cache only."""
+    pv = product_view(pid)
+    if not pv: return None
+    fp = flash_pct(pid)
+    return (pv["vid"], flash_tiers(pv["tiers"], fp) if fp else pv["tiers"],
+            available(pid, pv["row"].get("stock", -1), uid))
+
 async def show_product(u, ctx):
-    q = u.callback_query; pid = int(q.data.split("_")[1])
-    row = q1("SELECT * FROM products WHERE id=? AND hidden=0", (pid,))
-    if not row: await safe_edit(q, "❌ Not available.", reply_markup=back_kb()); return
-    qx("UPDATE products SET views=COALESCE(views,0)+1 WHERE id=?", (pid,))
-    tiers = json.loads(row["tiers"]) if row.get("tiers") else TIERS[:]
-    vid = row.get("vendor_id", 1); stock = row.get("stock", -1); stock_txt = ""
+    q = u.callback_query
+    await send_product(ctx, q.message.chat_id, q.from_user.id, int(q.data.split("_")[1]), q)
+
+async def send_product(ctx, chat_id, uid, pid, q=None):
+    """Product screen. From a button (q) it replaces the tapped message;
+    from a /start prod_<id> deep link it is sent fresh."""
+    async def say(txt, **kw):
+        if q: await safe_edit(q, txt, **kw)
+        else: await ctx.bot.send_message(chat_id, txt, **kw)
+    pv = await arun(product_view, pid)
+    if not pv: await say("❌ Not available.", reply_markup=back_kb()); return
+    row = pv["row"]
+    count_view(pid)
+    tiers = pv["tiers"]; tier_txt = pv["tier_txt"]; kb = pv["kb"]
+    vid = pv["vid"]; stock = available(pid, row.get("stock", -1), uid); stock_txt = ""
     if stock == 0:
-        on_waitlist = bool(q1("SELECT 1 FROM product_waitlist WHERE user_id=? AND product_id=?", (q.from_user.id, pid)))
+        on_waitlist = bool(await aq1("SELECT 1 FROM product_waitlist WHERE user_id=? AND product_id=?", (uid, pid)))
         wl_btn = IB("✅ On Waitlist", "noop") if on_waitlist else IB("🔔 Notify Me", f"waitlist_join_{pid}")
-        await safe_edit(q, f"❌ <b>{hl.escape(row['name'])}</b> is out of stock.\n\nJoin the waitlist to be notified when it's back!", parse_mode="HTML",
+        await say(f"❌ <b>{hl.escape(row['name'])}</b> is out of stock.\n\nJoin the waitlist to be notified when it's back!", parse_mode="HTML",
             reply_markup=KM([wl_btn],
                             [IB("❤️ Wishlist", f"wish_add_{pid}")],
                             [IB("⬅️ Back", f"vend_{vid}")])); return
     elif 0 < stock <= 5: stock_txt = f"\n⚠️ <b>Only {stock} left!</b>"
-    fp = flash_pct(pid); flash_txt = ""
+    fp = await arun(flash_pct, pid); flash_txt = ""
     if fp:
-        tiers = [{"qty": t["qty"], "price": round(t["price"] * (1 - fp), 2)} for t in tiers]
+        tiers = flash_tiers(tiers, fp)
+        tier_txt = "".join(ft(t) + "\n" for t in tiers); kb = _product_kb(pid, tiers, 0, 1, vid)
         flash_txt = f"\n🔥 <b>FLASH SALE — {int(fp*100)}% OFF!</b>"
-    avg_row = q1("SELECT AVG(stars) as a, COUNT(*) as c FROM reviews WHERE product_name=?", (enc(row["name"]),))
+    avg_row = await aq1("SELECT AVG(stars) as a, COUNT(*) as c FROM reviews WHERE product_name=?", (enc(row["name"]),))
     rating_txt = ""
     if avg_row and avg_row.get("c", 0) > 0:
         rating_txt = f"\n⭐ {avg_row['a']:.1f}/5 ({avg_row['c']} reviews)"
-    cap = (("⭐ " if row.get("featured") else "🌿 ") +
-           f"<b>{hl.escape(row['name'])}</b>" + flash_txt + stock_txt + rating_txt +
-           f"\n\n{hl.escape(row['description'] or '')}\n\n" +
-           "".join(ft(t) + "\n" for t in tiers))
-    # Store tiers in user_data so +/- callbacks can access them
-    ctx.user_data[f"tiers_{pid}"] = tiers
+    cap = pv["title"] + flash_txt + stock_txt + rating_txt + pv["desc"] + tier_txt
     # Append public Q&A to caption
-    qa_rows = qa("SELECT question,answer FROM product_qa WHERE product_id=? AND answered=1 ORDER BY id DESC LIMIT 3", (pid,))
+    qa_rows = await aqa("SELECT question,answer FROM product_qa WHERE product_id=? AND answered=1 ORDER BY id DESC LIMIT 3", (pid,))
     if qa_rows:
         cap += "\n❓ <b>Q&A</b>\n" + "".join(
             f"Q: {hl.escape(r['question'][:80])}\nA: {hl.escape(r['answer'][:120])}\n\n" for r in qa_rows)
-    kb = _product_kb(pid, tiers, 0, 1, vid)
-    try: await q.message.delete()
-    except: pass
+    if q:
+        try: await q.message.delete()
+        except: pass
     if row.get("photo"):
-        await ctx.bot.send_photo(q.message.chat_id, row["photo"],
+        await ctx.bot.send_photo(chat_id, row["photo"],
             caption=cap[:1020], parse_mode="HTML", reply_markup=kb)
     else:
-        await q.message.reply_text(cap[:4000], parse_mode="HTML", reply_markup=kb)
+        await ctx.bot.send_message(chat_id, cap[:4000], parse_mode="HTML", reply_markup=kb)
+
+async def inline_search(u, ctx):
+    """@bot <term> — catalogue search answered from the in-memory index."""
+    iq = u.inline_query; term = iq.query.strip()
+    # Answers are cached per user, so a banned user can't be served someone else's results
+    if await arun(gate, iq.from_user.id, iq.from_user.username) == "banned":
+        await iq.answer([], cache_time=INLINE_CACHE, is_personal=True); return
+    if not term: await iq.answer([], cache_time=INLINE_CACHE, is_personal=True); return
+    try: offset = int(iq.offset or 0)
+    except ValueError: offset = 0
+    results, nxt = await arun(inline_results, term, offset, f"https://t.me/{ctx.bot.username}?start=")
+    await iq.answer(results, cache_time=INLINE_CACHE, next_offset=nxt, is_personal=True)
 
 async def product_tier_select(u, ctx):
     """User tapped a tier button — switch tier, keep qty_mult."""
     q = u.callback_query; parts = q.data.split("_")
     pid, tier_idx, qty_mult = int(parts[1]), int(parts[2]), int(parts[3])
-    row = q1("SELECT vendor_id,tiers,stock FROM products WHERE id=? AND hidden=0", (pid,))
-    if not row: await q.answer("❌ Not available.", show_alert=True); return
-    tiers = ctx.user_data.get(f"tiers_{pid}") or (json.loads(row["tiers"]) if row.get("tiers") else TIERS[:])
-    vid = row.get("vendor_id", 1)
+    pt = await arun(product_tiers, pid, q.from_user.id)
+    if not pt: await q.answer("❌ Not available.", show_alert=True); return
+    vid, tiers, _ = pt
+    if tier_idx >= len(tiers): tier_idx = 0
     try: await q.edit_message_reply_markup(reply_markup=_product_kb(pid, tiers, tier_idx, qty_mult, vid))
     except: pass
 
@@ -811,45 +1771,47 @@ async def product_qty_change(u, ctx):
     """User tapped + or - — update qty multiplier."""
     q = u.callback_query; parts = q.data.split("_")
     pid, tier_idx, qty_mult = int(parts[1]), int(parts[2]), int(parts[3])
-    row2 = q1("SELECT tiers FROM products WHERE id=?", (pid,))
-    tiers_raw = ctx.user_data.get(f"tiers_{pid}") or (json.loads(row2["tiers"]) if row2 and row2.get("tiers") else TIERS[:])
-    min_q = tiers_raw[tier_idx].get("min_qty", 1) if tier_idx < len(tiers_raw) else 1
+    pt = await arun(product_tiers, pid, q.from_user.id)
+    if not pt: await q.answer("❌ Not available.", show_alert=True); return
+    vid, tiers, left = pt
+    if tier_idx >= len(tiers): tier_idx = 0
+    min_q = tiers[tier_idx].get("min_qty", 1)
     if qty_mult < min_q: await q.answer(f"⚠️ Minimum is {min_q}x for this size.", show_alert=True); return
-    row = q1("SELECT vendor_id,tiers,stock FROM products WHERE id=? AND hidden=0", (pid,))
-    if not row: await q.answer("❌ Not available.", show_alert=True); return
-    tiers = ctx.user_data.get(f"tiers_{pid}") or (json.loads(row["tiers"]) if row.get("tiers") else TIERS[:])
-    vid = row.get("vendor_id", 1)
-    # Check stock
-    stock = row.get("stock", -1)
-    t = tiers[tier_idx]
-    total_qty = t["qty"] * qty_mult
-    if stock != -1 and total_qty > stock:
-        await q.answer(f"⚠️ Only {stock}g in stock!", show_alert=True); return
+    if left != -1 and tiers[tier_idx]["qty"] * qty_mult > left:
+        await q.answer(f"⚠️ Only {left}g in stock!", show_alert=True); return
     try: await q.edit_message_reply_markup(reply_markup=_product_kb(pid, tiers, tier_idx, qty_mult, vid))
     except: pass
 
 async def pick_weight(u, ctx):
     q = u.callback_query; p = q.data.split("_")
     pid, qty, price = int(p[1]), float(p[2]), float(p[3])
-    row = q1("SELECT name,vendor_id,stock FROM products WHERE id=? AND hidden=0", (pid,))
-    if not row: await q.answer("❌ Not available.", show_alert=True); return
-    if row.get("stock", -1) == 0: await q.answer("❌ Out of stock.", show_alert=True); return
-    qx("INSERT INTO cart(user_id,product_id,vendor_id,qty,price) VALUES(?,?,?,?,?)",
-       (q.from_user.id, pid, row.get("vendor_id", 1), qty, price))
+    pv = await arun(product_view, pid)
+    if not pv: await q.answer("❌ Not available.", show_alert=True); return
+    row = pv["row"]; stock = available(pid, row.get("stock", -1), q.from_user.id)
+    if stock == 0: await q.answer("❌ Out of stock.", show_alert=True); return
+    if stock != -1 and qty > stock: await q.answer(f"⚠️ Only {stock}g in stock!", show_alert=True); return
+    # The basket keeps the list price; any flash discount is applied by quote()
+    hit = list_price(pv["tiers"], qty, price, await arun(flash_pct, pid))
+    if hit is None: await q.answer("⚠️ Prices have changed — please reopen the product.", show_alert=True); return
+    await arun(CART.add, q.from_user.id, pid, pv["vid"], qty, hit[0], row["name"])
     qty_label = f"{int(qty)}g/qty" if qty == int(qty) else f"{qty}g/qty"
     await q.answer(f"✅ {qty_label} of {row['name']} added! (£{price:.2f})", show_alert=True)
 
 async def view_basket(u, ctx):
     q = u.callback_query; uid = q.from_user.id
-    items = qa("SELECT cart.id,products.name,cart.qty,cart.price,cart.vendor_id "
-               "FROM cart JOIN products ON cart.product_id=products.id "
-               "WHERE cart.user_id=? ORDER BY cart.id", (uid,))
+    items = await arun(CART.items, uid)
     if not items:
         await safe_edit(q, "🧺 Basket empty.",
             reply_markup=KM([IB("🏪 Browse", "vendors")], [IB("⬅️ Back", "menu")])); return
-    total = sum(r["price"] for r in items)
+    # Priced like checkout (before delivery and codes), one quote per vendor in the basket
+    qts = await arun(lambda: [quote([r for r in items if r["vendor_id"] == v], pricing_policy(v))
+                              for v in sorted({r["vendor_id"] for r in items})])
+    flash = round(sum(qt["flash"] for qt in qts), 2); bulk = round(sum(qt["bulk"] for qt in qts), 2)
+    total = round(sum(qt["total"] for qt in qts), 2)
+    fl = f"🔥 Flash sale -£{flash:.2f}\n" if flash else ""
+    bl = f"📦 Bulk deal -£{bulk:.2f}\n" if bulk else ""
     txt = ("🧺 <b>Basket</b>\n━━━━━━━━━━━━━━━━━━━━\n\n" +
-           "".join(f"• {hl.escape(r['name'])} {fq(r['qty'])} — £{r['price']:.2f}\n" for r in items) +
+           "".join(f"• {hl.escape(r['name'])} {fq(r['qty'])} — £{r['price']:.2f}\n" for r in items) + fl + bl +
            f"\n━━━━━━━━━━━━━━━━━━━━\n💰 <b>Total: £{total:.2f}</b>")
     await safe_edit(q, txt, parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(
@@ -858,24 +1820,59 @@ async def view_basket(u, ctx):
 
 async def remove_item(u, ctx):
     q = u.callback_query
-    qx("DELETE FROM cart WHERE id=? AND user_id=?", (int(q.data.split("_")[1]), q.from_user.id))
+    await arun(CART.remove, q.from_user.id, int(q.data.split("_")[1]))
     await view_basket(u, ctx)
 
 async def clear_cart(u, ctx):
-    q = u.callback_query; qx("DELETE FROM cart WHERE user_id=?", (q.from_user.id,))
+    q = u.callback_query; await arun(CART.clear, q.from_user.id)
     await view_basket(u, ctx)
 
 # ── CHECKOUT ───────────────────────────────────────────────────────────────────
+class OutOfStock(Exception):
+    """place_order() could not cover every basket line; .items is [(name, stock_left)]."""
+    def __init__(self, items):
+        super().__init__(", ".join(n for n, _ in items)); self.items = items
+
+def out_of_stock_txt(e):
+    return ("❌ <b>Not enough stock</b>\n\n" +
+            "".join(f"• {hl.escape(n)} — {'sold out' if left == 0 else f'only {left} left'}\n" for n, left in e.items) +
+            "\nPlease update your basket.")
+
+def place_order(o, items):
+    """Checkout engine: the whole order in one transaction with a fixed number of
+    statements whatever the basket size. The basket's stock is reserved for the
+    order first (see reserve); if any line can't be covered nothing is written
+    and OutOfStock names the products."""
+    with tx() as t:
+        reserve(t, o["user_id"], basket_need(items), o["id"], ORDER_HOLD)
+        t.qx("WITH o AS (INSERT INTO orders(id,user_id,vendor_id,cust_name,address,summary,gbp,"
+             "vendor_gbp,platform_gbp,ltc,ltc_rate,ltc_addr,status,ship,rate_expires) "
+             "VALUES(?,?,?,?,?,?,?,?,?,?,?,COALESCE((SELECT address FROM crypto_wallets "
+             "WHERE vendor_id=? AND is_active=1 ORDER BY id DESC LIMIT 1),?),'Pending',?,?) RETURNING id) "
+             "INSERT INTO order_timeline(order_id,event) SELECT id,'Order placed' FROM o",
+             (o["id"], o["user_id"], o["vendor_id"], enc(o["name"]), enc(o["address"]), enc(o["summary"]),
+              o["gbp"], o["vendor_gbp"], o["platform_gbp"], o["ltc"], o["ltc_rate"],
+              o["vendor_id"], PLATFORM_LTC, o["ship"], o["rate_expires"]))
+        t.qx("DELETE FROM cart WHERE user_id=? AND vendor_id=?", (o["user_id"], o["vendor_id"]))
+        if o.get("note"):
+            t.qx("INSERT INTO order_customer_notes(order_id,note) VALUES(?,?) ON CONFLICT DO NOTHING",
+                 (o["id"], enc(o["note"])))
+        if o.get("disc_code"): use_disc(o["disc_code"], t)
+        if o["ship"] == "drop":
+            t.qx("INSERT INTO drop_chats(order_id,user_id,sender,message) VALUES(?,?,?,?)",
+                 (o["id"], o["user_id"], "vendor",
+                  enc(f"👋 Hi {o['name']}! Order received. Message to arrange pickup.")))
+
 async def checkout_start(u, ctx):
     q = u.callback_query; uid = q.from_user.id
-    items = qa("SELECT vendor_id,price FROM cart WHERE user_id=?", (uid,))
+    items = await arun(CART.items, uid)
     if not items: await safe_edit(q, "🧺 Basket empty.", reply_markup=menu()); return
     vids = list(set(r["vendor_id"] for r in items))
     # Block checkout if vendor is on holiday
     for hv in vids:
-        h = get_vendor_holiday(hv)
+        h = await arun(get_vendor_holiday, hv)
         if h:
-            v = q1("SELECT name FROM vendors WHERE id=?", (hv,))
+            v = await aq1("SELECT name FROM vendors WHERE id=?", (hv,))
             msg = h.get("message","") or "Back soon!"
             await safe_edit(q,
                 f"🏖️ <b>{hl.escape(v['name'] if v else 'Vendor')} is on holiday</b>\n"
@@ -885,14 +1882,18 @@ async def checkout_start(u, ctx):
         await safe_edit(q, "⚠️ <b>Mixed vendors</b>\n\nCheckout one vendor at a time.", parse_mode="HTML",
             reply_markup=KM([IB("🗑️ Clear", "clear_cart")], [IB("⬅️ Back", "basket")])); return
     vid = vids[0]
-    min_order = float(gs("min_order", "0"))
+    min_order = float(await arun(gs, "min_order", "0"))
     sub = round(sum(r["price"] for r in items), 2)
     if min_order > 0 and sub < min_order:
         await safe_edit(q, f"⚠️ Minimum order is <b>£{min_order:.2f}</b>.", parse_mode="HTML",
             reply_markup=back_kb()); return
+    try: await arun(hold_basket, uid, items)
+    except OutOfStock as e:
+        await safe_edit(q, out_of_stock_txt(e), parse_mode="HTML",
+            reply_markup=KM([IB("🧺 Basket", "basket")], [IB("⬅️ Back", "menu")])); return
     ctx.user_data.update({"co_name": None, "co_addr": None, "co_ship": None,
                           "co_disc_code": None, "co_disc_pct": 0,
-                          "co_sub": sub, "co_vid": vid, "wf": None})
+                          "co_vid": vid, "wf": None})
     t, _ = co_summary(ctx.user_data, uid)
     await safe_edit(q, t, parse_mode="HTML", reply_markup=co_kb(ctx.user_data))
 
@@ -936,46 +1937,36 @@ async def co_confirm(u, ctx):
     name, addr, sk = ud.get("co_name"), ud.get("co_addr") or "", ud.get("co_ship")
     if not name or not sk: await q.answer("⚠️ Enter name and select delivery.", show_alert=True); return
     if sk == "tracked24" and not addr: await q.answer("⚠️ Enter delivery address.", show_alert=True); return
-    vid = ud.get("co_vid", 1); vendor = q1("SELECT * FROM vendors WHERE id=?", (vid,))
+    vid = ud.get("co_vid", 1)
+    items, policy, qt = await arun(checkout_quote, ud, uid); vendor = policy["vendor"]
     if not vendor: await safe_edit(q, "❌ Vendor error.", reply_markup=menu()); return
-    items = qa("SELECT products.name,cart.qty,cart.price,cart.product_id FROM cart "
-               "JOIN products ON cart.product_id=products.id "
-               "WHERE cart.user_id=? AND cart.vendor_id=?", (uid, vid))
     if not items: await safe_edit(q, "🧺 Basket empty.", reply_markup=menu()); return
+    if qt["total"] != ud.get("co_total"):
+        t, _ = await arun(co_summary, ud, uid)
+        await safe_edit(q, "⚠️ <b>Prices have changed — please check your total.</b>\n\n" + t,
+            parse_mode="HTML", reply_markup=co_kb(ud)); return
     summary = ", ".join(r["name"] + " " + fq(r["qty"]) for r in items)
-    sub = round(sum(r["price"] for r in items), 2)
-    dp = ud.get("co_disc_pct", 0); sp = SHIP[sk]["price"]; needs_ltc = SHIP[sk]["ltc"]
-    disc = round(sub * dp, 2)
-    bulk_thresh = float(gs("bulk_threshold", "100")); bulk_pct = float(gs("bulk_pct", "5"))
-    bulk_disc = round((sub - disc) * bulk_pct / 100, 2) if (sub - disc) >= bulk_thresh else 0
-    gbp = round(sub - disc - bulk_disc + sp, 2)
-    com = vendor.get("commission_pct", 10) / 100
-    platform_gbp = round(gbp * com, 2); vendor_gbp = round(gbp - platform_gbp, 2)
-    rate = ltc_price(force=True); ltc = round(gbp / rate, 6) if needs_ltc else 0.0
+    needs_ltc = SHIP[sk]["ltc"]
+    gbp, platform_gbp, vendor_gbp = qt["total"], qt["platform"], qt["vendor"]
+    rate = await RATES.get() if needs_ltc else ltc_price()
+    if rate is None: await q.answer("⚠️ LTC rate unavailable — please try again shortly.", show_alert=True); return
+    ltc = round(gbp / rate, 6) if needs_ltc else 0.0
     rate_expires = (datetime.now() + timedelta(minutes=30)).isoformat() if needs_ltc else None
     oid = str(uuid4())[:8].upper()
     addr_disp = addr or "Local Drop"
-    # ── ENCRYPT PII before storing ──────────────────────────────────────────
-    qx("INSERT INTO orders(id,user_id,vendor_id,cust_name,address,summary,gbp,"
-       "vendor_gbp,platform_gbp,ltc,ltc_rate,ltc_addr,status,ship,rate_expires) "
-       "VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-       (oid, uid, vid,
-        enc(name), enc(addr_disp), enc(summary),
-        gbp, vendor_gbp, platform_gbp, ltc, rate, get_vendor_wallet(vid), "Pending", sk, rate_expires))
-    add_timeline(oid, "Order placed")
-    if ud.get("co_note"):
-        qx("INSERT INTO order_customer_notes(order_id,note) VALUES(?,?) ON CONFLICT DO NOTHING",
-           (oid, enc(ud["co_note"])))
-    qx("DELETE FROM cart WHERE user_id=? AND vendor_id=?", (uid, vid))
-    if ud.get("co_disc_code"): use_disc(ud["co_disc_code"])
-    for r in items:
-        p = q1("SELECT stock FROM products WHERE id=?", (r["product_id"],))
-        if p and p.get("stock", -1) > 0:
-            qx("UPDATE products SET stock=stock-1 WHERE id=?", (r["product_id"],))
-    if sk == "drop":
-        greeting = enc(f"👋 Hi {name}! Order received. Message to arrange pickup.")
-        qx("INSERT INTO drop_chats(order_id,user_id,sender,message) VALUES(?,?,?,?)",
-           (oid, uid, "vendor", greeting))
+    # PII is encrypted inside place_order
+    try:
+        await arun(place_order, {
+            "id": oid, "user_id": uid, "vendor_id": vid, "name": name, "address": addr_disp,
+            "summary": summary, "gbp": gbp, "vendor_gbp": vendor_gbp, "platform_gbp": platform_gbp,
+            "ltc": ltc, "ltc_rate": rate, "ship": sk, "rate_expires": rate_expires,
+            "note": ud.get("co_note"), "disc_code": ud.get("co_disc_code")}, items)
+    except OutOfStock as e:
+        await safe_edit(q, out_of_stock_txt(e), parse_mode="HTML",
+            reply_markup=KM([IB("🧺 Basket", "basket")], [IB("⬅️ Back", "menu")])); return
+    CART.clear(uid, vid)
+    try: await arun(CART.flush, [uid])
+    except Exception as e: print(f"⚠️ Cart flush: {e}")
     uname = q.from_user.username or str(uid)
     # Admin notification uses plaintext (admin channel — not persisted as PII in DB)
     cust_note_txt = ud.get("co_note", "")
@@ -984,15 +1975,13 @@ async def co_confirm(u, ctx):
              f"📦 {summary} · 🚚 {SHIP[sk]['label']} · 💷 £{gbp:.2f}\n"
              f"💰 Vendor: £{vendor_gbp:.2f} · Platform: £{platform_gbp:.2f}"
              + (f"\n📝 Customer note: {hl.escape(cust_note_txt)}" if cust_note_txt else ""))
-    try: await ctx.bot.send_message(CHANNEL_ID, notif, parse_mode="HTML")
-    except: pass
+    OUTBOX.send(CHANNEL_ID, notif, parse_mode="HTML", prio=P_PAY)
     # Public notification — NO name/address, just amount + user ID
     pub_notif = (f"🛒 <b>New Order Received</b>\n"
                  f"💷 £{gbp:.2f} · {SHIP[sk]['label']}\n"
                  f"🆔 User: <code>{uid}</code>\n"
                  f"📋 Order: <code>{oid}</code>")
-    try: await ctx.bot.send_message(NOTIFY_CHANNEL_ID, pub_notif, parse_mode="HTML")
-    except: pass
+    OUTBOX.send(NOTIFY_CHANNEL_ID, pub_notif, parse_mode="HTML", prio=P_PAY)
     adm_kb = InlineKeyboardMarkup(
         [[IB("✅ Confirm", f"adm_ok_{oid}"), IB("❌ Reject", f"adm_no_{oid}")]] +
         ([[IB("💬 Chat", f"dch_{oid}")]] if sk == "drop" else []))
@@ -1000,61 +1989,84 @@ async def co_confirm(u, ctx):
     if vendor.get("admin_user_id") and vendor["admin_user_id"] != ADMIN_ID:
         notify_ids.append(vendor["admin_user_id"])
     for rid in notify_ids:
-        try: await ctx.bot.send_message(rid, notif, parse_mode="HTML", reply_markup=adm_kb)
-        except: pass
+        OUTBOX.send(rid, notif, parse_mode="HTML", reply_markup=adm_kb, prio=P_PAY)
     for k in [k for k in list(ud) if k.startswith("co_")]: ud.pop(k)
     try: await q.message.delete()
     except: pass
-    invoice_txt, invoice_kb = build_invoice(oid)
+    invoice_txt, invoice_kb = await arun(build_invoice, oid)
     if invoice_txt:
         await ctx.bot.send_message(uid, invoice_txt, parse_mode="HTML", reply_markup=invoice_kb)
 
 async def refresh_rate_cb(u, ctx):
     q = u.callback_query; oid = q.data.split("_", 2)[2]; uid = q.from_user.id
-    o = q1("SELECT * FROM orders WHERE id=? AND user_id=? AND status='Pending'", (oid, uid))
+    o = await aq1("SELECT * FROM orders WHERE id=? AND user_id=? AND status='Pending'", (oid, uid))
     if not o: await q.answer("❌ Cannot refresh.", show_alert=True); return
-    rate = ltc_price(force=True); ltc = round(o["gbp"] / rate, 6)
+    rate = await RATES.get()
+    if rate is None: await q.answer("⚠️ LTC rate unavailable — please try again shortly.", show_alert=True); return
+    ltc = round(o["gbp"] / rate, 6)
     rate_expires = (datetime.now() + timedelta(minutes=30)).isoformat()
-    qx("UPDATE orders SET ltc=?,ltc_rate=?,rate_expires=? WHERE id=?", (ltc, rate, rate_expires, oid))
-    add_timeline(oid, f"Rate refreshed: £{rate:.2f}/LTC = {ltc:.6f} LTC")
+    await aqx("UPDATE orders SET ltc=?,ltc_rate=?,rate_expires=? WHERE id=?", (ltc, rate, rate_expires, oid))
+    await arun(add_timeline, oid, f"Rate refreshed: £{rate:.2f}/LTC = {ltc:.6f} LTC")
     await q.answer("✅ Rate refreshed!", show_alert=True)
-    invoice_txt, invoice_kb = build_invoice(oid)
+    invoice_txt, invoice_kb = await arun(build_invoice, oid)
     try: await q.edit_message_text(invoice_txt, parse_mode="HTML", reply_markup=invoice_kb)
     except:
         try: await q.message.delete()
         except: pass
         await ctx.bot.send_message(uid, invoice_txt, parse_mode="HTML", reply_markup=invoice_kb)
 
+ORDERS_SQL = ("SELECT o.id,o.gbp,o.status,o.ship,o.summary,o.ltc,o.chat_closed,v.name as vname,v.emoji as vemoji "
+              "FROM orders o LEFT JOIN vendors v ON v.id=o.vendor_id WHERE o.user_id=? ")
+
+def order_page(uid, older=None, newer=None):
+    """One page of a user's orders, newest first, keyset-paginated on (created_at,id).
+    older/newer is the order id at the edge of the current page. Returns (rows, has_older, has_newer)."""
+    if newer:
+        rows = qa(ORDERS_SQL + "AND (o.created_at,o.id) > (SELECT created_at,id FROM orders WHERE id=?) "
+                  "ORDER BY o.created_at,o.id LIMIT ?", (uid, newer, ORDERS_PP + 1))
+        more = len(rows) > ORDERS_PP; rows = rows[:ORDERS_PP][::-1]
+        return rows, True, more
+    if older:
+        rows = qa(ORDERS_SQL + "AND (o.created_at,o.id) < (SELECT created_at,id FROM orders WHERE id=?) "
+                  "ORDER BY o.created_at DESC,o.id DESC LIMIT ?", (uid, older, ORDERS_PP + 1))
+    else:
+        rows = qa(ORDERS_SQL + "ORDER BY o.created_at DESC,o.id DESC LIMIT ?", (uid, ORDERS_PP + 1))
+    return rows[:ORDERS_PP], len(rows) > ORDERS_PP, bool(older)
+
 async def view_orders(u, ctx):
-    q = u.callback_query; uid = q.from_user.id
-    rows = qa("SELECT id,gbp,status,ship,summary,vendor_id,ltc FROM orders WHERE user_id=? ORDER BY id DESC", (uid,))
-    if not rows:
+    q = u.callback_query; uid = q.from_user.id; d = q.data
+    rows, has_older, has_newer = await arun(order_page, uid,
+        d[5:] if d.startswith("ordp_") else None, d[5:] if d.startswith("ordn_") else None)
+    if not rows and not has_newer:
         await safe_edit(q, "📭 No orders yet!",
             reply_markup=KM([IB("🏪 Browse", "vendors")], [IB("⬅️ Back", "menu")])); return
+    if not rows:
+        rows, has_older, has_newer = await arun(order_page, uid)
     sm = {"Pending": ("🕐","Pending"), "Paid": ("✅","Confirmed"),
           "Dispatched": ("🚚","Dispatched"), "Rejected": ("❌","Rejected")}
     txt = "📦 <b>Your Orders</b>\n━━━━━━━━━━━━━━━━━━━━\n\n"; kb = []
     for o in rows:
         icon, lbl = sm.get(o["status"], ("📋", o["status"]))
         dp = "📍" if o["ship"] == "drop" else "📦"
-        v = q1("SELECT name,emoji FROM vendors WHERE id=?", (o["vendor_id"],))
-        vtxt = (f" · {v['emoji']} {v['name']}") if v else ""
+        vtxt = (f" · {o['vemoji']} {o['vname']}") if o["vname"] else ""
         summary_dec = dec(o["summary"])
         txt += f"{icon} <b>{o['id']}</b> · {lbl}{vtxt} · {dp} · £{o['gbp']:.2f}\n{hl.escape(summary_dec)}\n\n"
         if o["ship"] == "drop" and o["status"] in ("Pending","Paid","Dispatched"):
-            kb.append([IB(("🔒" if gs("cc_"+o["id"],"0")=="1" else "💬") + " Chat — " + o["id"], "dcv_"+o["id"])])
+            kb.append([IB(("🔒" if o["chat_closed"] else "💬") + " Chat — " + o["id"], "dcv_"+o["id"])])
         if o["status"] == "Pending" and o.get("ltc", 0) > 0:
             kb.append([IB(f"🧾 Invoice — {o['id']}", f"show_invoice_{o['id']}")])
         kb.append([IB(f"📍 Track — {o['id']}", f"timeline_{o['id']}")])
+    nav = ([IB("◀️ Newer", f"ordn_{rows[0]['id']}")] if has_newer else []) + \
+          ([IB("Older ▶️", f"ordp_{rows[-1]['id']}")] if has_older else [])
     await safe_edit(q, txt[:4000], parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(kb + [[IB("⬅️ Back", "menu")]]))
+        reply_markup=InlineKeyboardMarkup(kb + ([nav] if nav else []) + [[IB("⬅️ Back", "menu")]]))
 
 async def view_timeline(u, ctx):
     q = u.callback_query; oid = q.data.split("_")[1]; uid = q.from_user.id
-    if not is_admin(uid) and not q1("SELECT 1 FROM orders WHERE id=? AND user_id=?", (oid, uid)):
+    if not await arun(is_admin, uid) and not await aq1("SELECT 1 FROM orders WHERE id=? AND user_id=?", (oid, uid)):
         await q.answer("❌ Not found.", show_alert=True); return
-    o = q1("SELECT status,gbp,summary,ship,ltc FROM orders WHERE id=?", (oid,))
-    events = qa("SELECT event,created_at FROM order_timeline WHERE order_id=? ORDER BY created_at", (oid,))
+    o = await aq1("SELECT status,gbp,summary,ship,ltc FROM orders WHERE id=?", (oid,))
+    events = await aqa("SELECT event,created_at FROM order_timeline WHERE order_id=? ORDER BY created_at", (oid,))
     txt = (f"📍 <b>Order {oid}</b>\n━━━━━━━━━━━━━━━━━━━━\n"
            f"Status: <b>{o['status']}</b> · 💷 £{o['gbp']:.2f}\n\n")
     txt += "\n".join(f"• {e['event']}\n  <i>{str(e['created_at'])[:16]}</i>" for e in events) if events else "<i>No events yet.</i>"
@@ -1066,20 +2078,20 @@ async def view_timeline(u, ctx):
 
 async def show_invoice_cb(u, ctx):
     q = u.callback_query; oid = q.data.split("show_invoice_")[1]; uid = q.from_user.id
-    if not is_admin(uid) and not q1("SELECT 1 FROM orders WHERE id=? AND user_id=?", (oid, uid)):
+    if not await arun(is_admin, uid) and not await aq1("SELECT 1 FROM orders WHERE id=? AND user_id=?", (oid, uid)):
         await q.answer("❌ Not found.", show_alert=True); return
-    invoice_txt, invoice_kb = build_invoice(oid)
+    invoice_txt, invoice_kb = await arun(build_invoice, oid)
     try: await q.message.delete()
     except: pass
     await ctx.bot.send_message(uid, invoice_txt, parse_mode="HTML", reply_markup=invoice_kb)
 
 async def user_paid(u, ctx):
     q = u.callback_query; oid = q.data[5:]
-    row = q1("SELECT ship,cust_name,summary,gbp,ltc,vendor_id FROM orders WHERE id=?", (oid,))
+    row = await aq1("SELECT ship,cust_name,summary,gbp,ltc,vendor_id FROM orders WHERE id=?", (oid,))
     if not row: await safe_edit(q, "❌ Not found.", reply_markup=back_kb()); return
     sl = SHIP.get(row["ship"], {}).get("label", row["ship"])
     cust_name = dec(row["cust_name"]); summary = dec(row["summary"])
-    vendor = q1("SELECT admin_user_id FROM vendors WHERE id=?", (row["vendor_id"],))
+    vendor = await aq1("SELECT admin_user_id FROM vendors WHERE id=?", (row["vendor_id"],))
     notif = (f"💰 <b>MANUAL PAYMENT CLAIM — {oid}</b>\n"
              f"👤 {hl.escape(cust_name)} · {hl.escape(summary)}\n"
              f"💷 £{row['gbp']:.2f} · 💠 {row['ltc']:.6f} LTC\n"
@@ -1089,8 +2101,7 @@ async def user_paid(u, ctx):
     if vendor and vendor.get("admin_user_id") and vendor["admin_user_id"] != ADMIN_ID:
         notify_ids.append(vendor["admin_user_id"])
     for rid in notify_ids:
-        try: await ctx.bot.send_message(rid, notif, parse_mode="HTML", reply_markup=adm_kb)
-        except: pass
+        OUTBOX.send(rid, notif, parse_mode="HTML", reply_markup=adm_kb, prio=P_PAY)
     await safe_edit(q,
         f"⏳ <b>Payment Submitted</b>\n━━━━━━━━━━━━━━━━━━━━\n"
         f"📋 Order <code>{oid}</code>\n🛍️ {hl.escape(summary)}\n"
@@ -1211,14 +2222,14 @@ async def bundle_add_to_cart(u, ctx):
     if not pids: await q.answer("❌ Bundle is empty.", show_alert=True); return
     # Split bundle price equally across items
     per_item = round(b["price"] / len(pids), 2)
-    added = 0
-    for pid in pids:
-        row = q1("SELECT id,vendor_id,stock FROM products WHERE id=? AND hidden=0", (pid,))
-        if not row: continue
-        if row.get("stock", -1) == 0: continue
-        qx("INSERT INTO cart(user_id,product_id,vendor_id,qty,price) VALUES(?,?,?,?,?)",
-           (uid, pid, b["vendor_id"], 1.0, per_item))
-        added += 1
+    def add_all():
+        added = 0
+        for pid in pids:
+            pv = product_view(pid)
+            if not pv or available(pid, pv["row"].get("stock", -1), uid) == 0: continue
+            CART.add(uid, pid, b["vendor_id"], 1.0, per_item, pv["row"]["name"]); added += 1
+        return added
+    added = await arun(add_all)
     await q.answer(f"✅ {added} items from bundle added to basket!", show_alert=True)
 
 async def adm_bundles(u, ctx):
@@ -1316,9 +2327,13 @@ async def contact_vendor(u, ctx):
     await safe_edit(q, "💬 Type your message:", reply_markup=cancel_kb())
 
 # ── DROP CHAT ──────────────────────────────────────────────────────────────────
+def set_chat_closed(oid, closed):
+    qx("UPDATE orders SET chat_closed=? WHERE id=?", (1 if closed else 0, oid))
+
 async def dropchat_view(u, ctx):
-    q = u.callback_query; oid = q.data[4:]; closed = gs("cc_"+oid, "0") == "1"
-    o = q1("SELECT summary,gbp FROM orders WHERE id=?", (oid,))
+    q = u.callback_query; oid = q.data[4:]
+    o = q1("SELECT summary,gbp,chat_closed FROM orders WHERE id=?", (oid,))
+    closed = bool(o and o["chat_closed"])
     summary_dec = dec(o["summary"]) if o else ""
     hdr = (f"💬 <b>Drop Chat — Order {oid}</b>\n━━━━━━━━━━━━━━━━━━━━\n" +
            (f"🛍️ {hl.escape(summary_dec)} · 💷 £{o['gbp']:.2f}\n" if o else "") +
@@ -1364,8 +2379,9 @@ async def dropchat_history(u, ctx):
         order = q1("SELECT vendor_id FROM orders WHERE id=?", (q.data[4:],))
         if not order or order["vendor_id"] != v["id"]:
             await q.answer("❌ Not your order.", show_alert=True); return
-    oid = q.data[4:]; closed = gs("cc_"+oid, "0") == "1"
-    o = q1("SELECT cust_name,summary,gbp FROM orders WHERE id=?", (oid,))
+    oid = q.data[4:]
+    o = q1("SELECT cust_name,summary,gbp,chat_closed FROM orders WHERE id=?", (oid,))
+    closed = bool(o and o["chat_closed"])
     note = q1("SELECT note FROM order_notes WHERE order_id=?", (oid,))
     cust_name = dec(o["cust_name"]) if o else ""
     summary   = dec(o["summary"]) if o else ""
@@ -1387,16 +2403,15 @@ async def dropchat_close(u, ctx):
         order = q1("SELECT vendor_id FROM orders WHERE id=?", (oid,))
         if not order or order["vendor_id"] != v["id"]:
             await q.answer("❌ Not your order.", show_alert=True); return
-    ss("cc_"+oid, "1")
+    set_chat_closed(oid, True)
     r = q1("SELECT user_id FROM orders WHERE id=?", (oid,))
     if r:
-        try: await ctx.bot.send_message(r["user_id"], f"🔒 Chat {oid} closed.", reply_markup=menu())
-        except: pass
+        OUTBOX.send(r["user_id"], f"🔒 Chat {oid} closed.", reply_markup=menu(), prio=P_CHAT)
     await safe_edit(q, "🔒 Closed.",
         reply_markup=KM([IB("🔓 Reopen", f"dco_{oid}"), IB("⬅️ Back", "menu")]))
 
 async def dropchat_open(u, ctx):
-    q = u.callback_query; oid = q.data[4:]; ss("cc_"+oid, "0")
+    q = u.callback_query; oid = q.data[4:]; set_chat_closed(oid, False)
     await safe_edit(q, f"🔓 Chat {oid} reopened.\n\n{fmt_chat(oid)}",
         parse_mode="HTML", reply_markup=dc_user_kb(oid, False))
 
@@ -1579,23 +2594,22 @@ async def own_assign_admin_cb(u, ctx):
     admin_uid = int(q.data.split("own_assign_a_")[1])
     vid = ctx.user_data.get("assign_vid")
     if not vid: await q.answer("❌ No vendor selected.", show_alert=True); return
-    qx("UPDATE vendors SET admin_user_id=? WHERE id=?", (admin_uid, vid))
+    qx("UPDATE vendors SET admin_user_id=? WHERE id=?", (admin_uid, vid)); forget_principal(); bump_catalogue()
     v = q1("SELECT name FROM vendors WHERE id=?", (vid,))
     a = q1("SELECT username FROM admins WHERE user_id=?", (admin_uid,))
-    try:
-        await ctx.bot.send_message(admin_uid,
-            f"🎉 You've been assigned as admin of <b>{hl.escape(v['name'] if v else '?')}</b>!\n"
-            f"Use /admin to access your vendor panel.",
-            parse_mode="HTML")
-    except: pass
+    OUTBOX.send(admin_uid,
+        f"🎉 You've been assigned as admin of <b>{hl.escape(v['name'] if v else '?')}</b>!\n"
+        f"Use /admin to access your vendor panel.",
+        parse_mode="HTML", prio=P_CHAT)
     await safe_edit(q,
         f"✅ @{a['username'] if a else admin_uid} assigned to <b>{hl.escape(v['name'] if v else '?')}</b>!",
         parse_mode="HTML", reply_markup=back_kb())
 
 async def cmd_admin(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = u.effective_user.id
-    qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
-       (uid, u.effective_user.username or ""))
+    if not is_known(uid):
+        qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
+           (uid, u.effective_user.username or "")); forget_principal(uid)
     if is_vendor_admin(uid):
         v = get_vendor(uid); ctx.user_data["cur_vid"] = v["id"]
         await _vendor_panel(u.message, v); return
@@ -1663,36 +2677,35 @@ async def _vendor_panel(msg, v):
 # ── ADMIN ACTIONS ──────────────────────────────────────────────────────────────
 async def adm_confirm(u, ctx):
     q = u.callback_query; oid = q.data[7:]
-    qx("UPDATE orders SET status='Paid' WHERE id=?", (oid,))
-    add_timeline(oid, "Payment confirmed by admin")
-    r = q1("SELECT user_id,ship,gbp,vendor_id FROM orders WHERE id=?", (oid,))
-    if r:
-        vg = (q1("SELECT vendor_gbp FROM orders WHERE id=?", (oid,)) or {}).get("vendor_gbp", 0)
-        credit_vendor_balance(r["vendor_id"], vg)
-        pts, cr = add_points(r["user_id"], r.get("gbp", 0))
-        new_tier = update_vip_tier(r["user_id"])
+    def confirm():
+        with tx() as t: paid = mark_paid(t, oid, "Payment confirmed by admin")
+        return paid_sync(paid)
+    paid = await arun(confirm)
+    if paid:
+        r, pts, cr, new_tier = paid
         lnote = f"\n🎁 +{pts} pts!" + (f" 💳 £{int(cr)} credit!" if cr else "")
         if new_tier: lnote += f"\n🏆 VIP upgrade: {new_tier}!"
-        try:
-            if r["ship"] == "drop":
-                await ctx.bot.send_message(r["user_id"],
-                    f"✅ <b>Order {oid} confirmed!</b> Open Drop Chat to arrange.{lnote}",
-                    parse_mode="HTML", reply_markup=KM([IB("💬 Drop Chat", f"dcv_{oid}")]))
-            else:
-                await ctx.bot.send_message(r["user_id"],
-                    f"✅ Payment confirmed — <code>{oid}</code>! 🌟{lnote}",
-                    parse_mode="HTML", reply_markup=KM([IB("⭐ Leave Review", f"review_{oid}")]))
-        except: pass
-    await safe_edit(q, f"✅ Order {oid} confirmed.")
+        if r["ship"] == "drop":
+            OUTBOX.send(r["user_id"],
+                f"✅ <b>Order {oid} confirmed!</b> Open Drop Chat to arrange.{lnote}",
+                parse_mode="HTML", reply_markup=KM([IB("💬 Drop Chat", f"dcv_{oid}")]), prio=P_PAY)
+        else:
+            OUTBOX.send(r["user_id"],
+                f"✅ Payment confirmed — <code>{oid}</code>! 🌟{lnote}",
+                parse_mode="HTML", reply_markup=KM([IB("⭐ Leave Review", f"review_{oid}")]), prio=P_PAY)
+        await safe_edit(q, f"✅ Order {oid} confirmed.")
+    else: await safe_edit(q, f"ℹ️ Order {oid} is no longer pending — nothing to confirm.")
 
 async def adm_reject(u, ctx):
     q = u.callback_query; oid = q.data[7:]
-    qx("UPDATE orders SET status='Rejected' WHERE id=?", (oid,))
-    add_timeline(oid, "Order rejected")
+    def reject():
+        with tx() as t:
+            t.qx("UPDATE orders SET status='Rejected' WHERE id=?", (oid,))
+            add_timeline(oid, "Order rejected", t); release_order(oid, t)
+    await arun(reject)
     r = q1("SELECT user_id FROM orders WHERE id=?", (oid,))
     if r:
-        try: await ctx.bot.send_message(r["user_id"], f"❌ Order <code>{oid}</code> rejected.", parse_mode="HTML")
-        except: pass
+        OUTBOX.send(r["user_id"], f"❌ Order <code>{oid}</code> rejected.", parse_mode="HTML", prio=P_PAY)
     await safe_edit(q, f"❌ Rejected {oid}.")
 
 async def adm_dispatch(u, ctx):
@@ -1713,10 +2726,8 @@ async def adm_dispatch(u, ctx):
                    f"🚚 {SHIP.get(o['ship'],{}).get('label',o['ship'])}\n{sep}\n"
                    f"💷 £{o['gbp']:.2f} — <b>PAID ✅</b>\n{sep}\n"
                    f"📬 <i>Your order is on its way!</i>")
-        try:
-            await ctx.bot.send_message(r["user_id"], receipt, parse_mode="HTML",
-                reply_markup=KM([IB("⭐ Leave Review", f"review_{oid}")], [IB("📦 My Orders", "orders")]))
-        except: pass
+        OUTBOX.send(r["user_id"], receipt, parse_mode="HTML",
+            reply_markup=KM([IB("⭐ Leave Review", f"review_{oid}")], [IB("📦 My Orders", "orders")]), prio=P_PAY)
         qx("INSERT INTO review_reminders(order_id,user_id,dispatched) VALUES(?,?,?) ON CONFLICT DO NOTHING",
            (oid, r["user_id"], datetime.now().isoformat()))
     await safe_edit(q, f"🚚 Dispatched {oid}.")
@@ -1811,7 +2822,7 @@ async def adm_stats(u, ctx):
                f"☀️ Today: <b>{td['c']}</b> · 💷 £{td['s']:.2f}\n"
                f"⏳ Pending: <b>{pend['c']}</b>\n"
                f"👥 Total users: <b>{users['c']}</b>\n"
-               f"💠 LTC rate: £{rate:.2f}")
+               f"💠 LTC rate: £{rate:.2f} ({RATES.info()})")
     await safe_edit(q, txt, parse_mode="HTML", reply_markup=back_kb())
 
 async def adm_ref_settings(u, ctx):
@@ -1872,11 +2883,13 @@ async def adm_settings_cb(u, ctx):
         f"⚙️ <b>Platform Settings</b>\n━━━━━━━━━━━━━━━━━━━━\n\n"
         f"📦 Min order: <b>£{gs('min_order','0')}</b>\n"
         f"🛒 Bulk threshold: <b>£{gs('bulk_threshold','100')}</b>\n"
-        f"💸 Bulk discount: <b>{gs('bulk_pct','5')}%</b>\n\n"
+        f"💸 Bulk discount: <b>{gs('bulk_pct','5')}%</b>\n"
+        f"💠 LTC confirmations to mark paid: <b>{gs('pay_confs','1')}</b>\n\n"
         f"<b>To change, use:</b>\n"
         f"/set min_order VALUE\n"
         f"/set bulk_threshold VALUE\n"
-        f"/set bulk_pct VALUE",
+        f"/set bulk_pct VALUE\n"
+        f"/set pay_confs VALUE",
         parse_mode="HTML", reply_markup=back_kb())
 
 async def adm_report_cb(u, ctx):
@@ -1896,16 +2909,15 @@ async def ltccheck_btn_cb(u, ctx):
     if not is_admin(u.effective_user.id): return
     try:
         active_wallet = get_active_wallet()
-        data = requests.get(f"https://api.blockcypher.com/v1/ltc/main/addrs/{active_wallet}/balance", timeout=10).json()
-        bal_ltc = data.get("balance", 0) / 100000000
-        unconf  = data.get("unconfirmed_balance", 0) / 100000000
+        bal, unconf = await CHAIN.balance(active_wallet)
+        bal_ltc, unconf = bal / SAT, unconf / SAT
         rate    = ltc_price()
         await safe_edit(q,
             f"💠 <b>Platform Wallet</b>\n━━━━━━━━━━━━━━━━━━━━\n"
             f"<code>{active_wallet}</code>\n\n"
             f"✅ Confirmed: <b>{bal_ltc:.6f} LTC</b> (≈ £{bal_ltc*rate:.2f})\n"
             f"⏳ Unconfirmed: <b>{unconf:.6f} LTC</b>\n"
-            f"📊 Rate: £{rate:.2f}/LTC",
+            f"📊 Rate: £{rate:.2f}/LTC ({RATES.info()})",
             parse_mode="HTML", reply_markup=back_kb())
     except Exception as e:
         await safe_edit(q, f"❌ Could not fetch: {e}", reply_markup=back_kb())
@@ -1934,7 +2946,7 @@ async def adm_togglevend(u, ctx):
     q = u.callback_query
     if not is_admin(u.effective_user.id): return
     vid = int(q.data.split("_")[1]); v = q1("SELECT active FROM vendors WHERE id=?", (vid,))
-    if v: qx("UPDATE vendors SET active=? WHERE id=?", (0 if v["active"] else 1, vid))
+    if v: qx("UPDATE vendors SET active=? WHERE id=?", (0 if v["active"] else 1, vid)); forget_principal(); bump_catalogue()
     await adm_vendors(u, ctx)
 
 async def adm_msgs(u, ctx):
@@ -2005,12 +3017,12 @@ async def adm_drops(u, ctx):
     q = u.callback_query; uid = q.from_user.id
     if not is_admin(uid) and not is_vendor_admin(uid): return
     vid = get_vid(ctx, uid)
-    rows = qa("SELECT o.id,o.cust_name,o.status,"
+    rows = qa("SELECT o.id,o.cust_name,o.status,o.chat_closed,"
               "(SELECT COUNT(*) FROM drop_chats d WHERE d.order_id=o.id) as msgs "
               "FROM orders o WHERE o.ship='drop' AND o.vendor_id=? ORDER BY o.id DESC LIMIT 20", (vid,))
     if not rows: await safe_edit(q, "📍 No drop orders.", reply_markup=back_kb()); return
     em = {"Pending":"⏳","Paid":"✅","Dispatched":"🚚","Rejected":"❌"}
-    kb = [[IB(("🔒" if gs("cc_"+o["id"],"0")=="1" else "💬") +
+    kb = [[IB(("🔒" if o["chat_closed"] else "💬") +
               f" {o['id']} · {dec(o['cust_name'])} {em.get(o['status'],'')} ({o['msgs']})",
               f"dch_{o['id']}")] for o in rows] + [[IB("⬅️ Back", "menu")]]
     await safe_edit(q, "📍 <b>Drop Orders</b>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(kb))
@@ -2055,7 +3067,7 @@ async def adm_rmadmin(u, ctx):
     uid = int(q.data.split("adm_rmadmin_")[1])
     if uid == ADMIN_ID: await q.answer("❌ Cannot remove owner.", show_alert=True); return
     r = q1("SELECT username FROM admins WHERE user_id=?", (uid,))
-    qx("DELETE FROM admins WHERE user_id=?", (uid,))
+    qx("DELETE FROM admins WHERE user_id=?", (uid,)); forget_principal(uid)
     await q.answer(f"✅ Removed {r['username'] if r else uid}", show_alert=True)
     await adm_admins(u, ctx)
 
@@ -2078,7 +3090,7 @@ async def adm_ban_start(u, ctx):
 async def adm_unban(u, ctx):
     q = u.callback_query
     if not is_admin(u.effective_user.id): return
-    uid = int(q.data.split("_")[1]); qx("UPDATE users SET banned=0 WHERE user_id=?", (uid,))
+    uid = int(q.data.split("_")[1]); qx("UPDATE users SET banned=0 WHERE user_id=?", (uid,)); forget_principal(uid)
     await q.answer("✅ Unbanned", show_alert=True); await adm_bans(u, ctx)
 
 async def adm_custnotes(u, ctx):
@@ -2113,6 +3125,209 @@ async def adm_adddisc_start(u, ctx):
         "🏷️ Add code:\n<code>CODE,PCT</code> or <code>CODE,PCT,HOURS</code> or <code>CODE,PCT,HOURS,MAXUSES</code>",
         parse_mode="HTML", reply_markup=cancel_kb())
 
+# ── OUTBOX ─────────────────────────────────────────────────────────────────────
+# Notifications to other chats, job messages and broadcasts go through
+# OUTBOX.send(). Payment messages overtake chat, chat overtakes marketing. No
+# chat gets more than one message per OUT_PER_CHAT (OUT_PER_GROUP for groups and
+# channels), and all chats share one global token bucket. A RetryAfter pauses the
+# bucket and requeues the message instead of dropping it. Replies to the user's
+# own tap (safe_edit, reply_text, the invoice after checkout) still go out directly.
+OUT_PER_CHAT  = 1.0   # seconds between messages to one private chat
+OUT_PER_GROUP = 3.0   # … to one group or channel (Telegram allows ~20/min)
+OUT_WORKERS   = 8
+OUT_TRIES     = 5     # transient failures before a message is given up
+P_PAY, P_CHAT, P_MKT = 0, 1, 2
+
+class TokenBucket:
+    """rate tokens/s up to burst; hold(secs) stalls every taker (flood wait)."""
+    def __init__(self, rate, burst=None):
+        self.rate, self.burst = rate, burst or rate
+        self.tokens, self.ts, self.until, self.lock = self.burst, time.monotonic(), 0.0, asyncio.Lock()
+
+    async def take(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.until: await asyncio.sleep(self.until - now); continue
+                self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate); self.ts = now
+                if self.tokens >= 1: self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def hold(self, secs): self.until = max(self.until, time.monotonic() + secs)
+
+def retry_secs(e):
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+class _Outbox:
+    def __init__(self):
+        self.bucket, self.q, self.bot, self.workers = TokenBucket(OUT_RATE), None, None, []
+        self.seq, self.next_at, self.queued = itertools.count(), {}, {}
+
+    def start(self, bot):
+        self.bot, self.q = bot, asyncio.PriorityQueue()
+        self.workers = [asyncio.get_running_loop().create_task(self._work()) for _ in range(OUT_WORKERS)]
+
+    def send(self, chat_id, text=None, prio=P_CHAT, key=None, photo=None, **kw):
+        """Queue a message; returns a future that becomes True once it is sent
+        (False if Telegram refuses it for good). Handlers shouldn't await it: use
+        tell_undelivered(). With key=, a message still waiting under the same key
+        is replaced (latest wins); without one every message goes out."""
+        key = (chat_id, key if key is not None else object())
+        m = self.queued.get(key)
+        if m:
+            m["text"], m["photo"], m["kw"] = text, photo, kw
+            if prio < m["prio"]: m["prio"] = prio; self._put(m)
+            return m["fut"]
+        m = {"chat": chat_id, "text": text, "photo": photo, "kw": kw, "prio": prio, "key": key, "tries": 0,
+             "fut": asyncio.get_running_loop().create_future()}
+        self.queued[key] = m; self._put(m)
+        return m["fut"]
+
+    def _put(self, m):
+        # A fresh seq makes any older heap entry for m stale
+        m["seq"] = next(self.seq); self.q.put_nowait((m["prio"], m["seq"], m))
+
+    def _retry(self, m, secs):
+        newer = self.queued.get(m["key"])
+        if newer:  # superseded while in flight: settle with the newer copy
+            newer["fut"].add_done_callback(
+                lambda f: m["fut"].done() or m["fut"].set_result(not f.cancelled() and f.result()))
+            return
+        self.queued[m["key"]] = m
+        asyncio.get_running_loop().call_later(secs, self._put, m)
+
+    async def _work(self):
+        while True:
+            _, seq, m = await self.q.get()
+            if seq != m["seq"]: continue
+            if m["fut"].done():  # its sender was cancelled; don't hand this future to later sends
+                if self.queued.get(m["key"]) is m: del self.queued[m["key"]]
+                continue
+            now = time.monotonic(); wait = self.next_at.get(m["chat"], 0) - now
+            if wait > 0:
+                asyncio.get_running_loop().call_later(wait, self._put, m); continue
+            if len(self.next_at) > 10000: self.next_at = {c: t for c, t in self.next_at.items() if t > now}
+            self.next_at[m["chat"]] = now + (OUT_PER_CHAT if isinstance(m["chat"], int) and m["chat"] > 0 else OUT_PER_GROUP)
+            await self.bucket.take()
+            self.queued.pop(m["key"], None)
+            try:
+                if m["photo"]: await self.bot.send_photo(m["chat"], m["photo"], caption=m["text"], **m["kw"])
+                else: await self.bot.send_message(m["chat"], m["text"], **m["kw"])
+                ok = True
+            except RetryAfter as e:
+                secs = retry_secs(e); self.bucket.hold(secs); self._retry(m, secs); continue
+            except (Forbidden, BadRequest) as e:
+                print(f"⚠️ Outbox {m['chat']}: {e}"); ok = False
+            except Exception as e:
+                m["tries"] += 1
+                if m["tries"] < OUT_TRIES: self._retry(m, 2 ** m["tries"]); continue
+                print(f"⚠️ Outbox {m['chat']} gave up: {e}"); ok = False
+            if not m["fut"].done(): m["fut"].set_result(ok)
+
+    async def drain(self, timeout=10):
+        """Let queued messages go out for up to timeout seconds, then stop."""
+        end = time.monotonic() + timeout
+        while self.queued and time.monotonic() < end: await asyncio.sleep(0.2)
+        for w in self.workers: w.cancel()
+
+OUTBOX = _Outbox()
+
+def tell_undelivered(fut, chat_id, what):
+    """Let chat_id know later if the message behind fut was never delivered."""
+    def done(f):
+        if f.cancelled() or not f.result(): OUTBOX.send(chat_id, f"❌ Could not deliver {what}.", prio=P_CHAT)
+    fut.add_done_callback(done)
+
+# ── BROADCAST ──────────────────────────────────────────────────────────────────
+# Announcements go out from a background task, not the admin's handler. Every
+# recipient is a row, so a restart resumes where it stopped (at most one batch
+# is re-sent), and broadcast_resume_job restarts any task that died. Messages go
+# through OUTBOX at marketing priority.
+_BROADCASTS = {}  # broadcast id -> running task
+
+def create_broadcast(aid, admin_id):
+    """Queue announcement aid for every non-banned user; returns (id, total)."""
+    with tx() as t:
+        bid = t.qxi("INSERT INTO broadcasts(announcement_id,admin_id) VALUES(?,?)", (aid, admin_id))
+        t.qx("INSERT INTO broadcast_recipients(broadcast_id,user_id) SELECT ?,user_id FROM users WHERE banned=0", (bid,))
+        total = t.q1("UPDATE broadcasts SET total=(SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id=?) "
+                     "WHERE id=? RETURNING total", (bid, bid))["total"]
+    return bid, total
+
+def _broadcast_save(bid, uids, res):
+    with tx() as t:
+        t.qx("UPDATE broadcast_recipients r SET state=s.state,attempts=r.attempts+1 "
+             "FROM unnest(?::bigint[],?::smallint[]) AS s(uid,state) WHERE r.broadcast_id=? AND r.user_id=s.uid",
+             (uids, res, bid))
+        t.qx("UPDATE broadcasts SET sent=sent+?,failed=failed+? WHERE id=?", (res.count(1), res.count(2), bid))
+
+def broadcast_txt(b, sent, failed, rate, status):
+    left = b["total"] - sent - failed
+    eta = f" · ETA {int(left / rate) // 60}m {int(left / rate) % 60}s" if rate and left and status == "running" else ""
+    head = {"running": "📤 Sending", "done": "✅ Finished", "cancelled": "⏹️ Stopped"}.get(status, status)
+    return (f"📢 <b>Broadcast #{b['id']}</b> — {head}\n"
+            f"✅ {sent} sent · ❌ {failed} failed · ⏳ {max(left, 0)} left of {b['total']}{eta}")
+
+async def run_broadcast(bot, bid):
+    b = await aq1("SELECT b.*,a.title,a.body,a.photo FROM broadcasts b "
+                  "JOIN announcements a ON a.id=b.announcement_id WHERE b.id=?", (bid,))
+    if not b or b["status"] != "running": return
+    txt = f"📢 <b>{hl.escape(b['title'] or '')}</b>\n\n{hl.escape(b['body'] or '')}"
+    sent, failed, sem = b["sent"], b["failed"], asyncio.Semaphore(BCAST_CONC)
+    t0, done0, last = time.monotonic(), sent + failed, 0.0
+
+    async def one(uid):
+        """1 sent, 2 failed (blocked the bot, gone, or kept failing)."""
+        async with sem:
+            try: ok = await OUTBOX.send(uid, txt[:1024] if b["photo"] else txt[:4096], P_MKT,
+                                        photo=b["photo"] or None, parse_mode="HTML")
+            except Exception as e: print(f"⚠️ Broadcast #{bid} → {uid}: {e}"); ok = False
+            return 1 if ok else 2
+
+    async def progress(status):
+        if not b.get("progress_msg"): return
+        rate = (sent + failed - done0) / max(time.monotonic() - t0, 1e-6)
+        kb = KM([IB("⏹️ Stop", f"bcstop_{bid}")]) if status == "running" else None
+        try: await bot.edit_message_text(broadcast_txt(b, sent, failed, rate, status), chat_id=b["progress_chat"],
+                                         message_id=b["progress_msg"], parse_mode="HTML", reply_markup=kb)
+        except Exception: pass
+
+    status = "running"
+    while True:
+        status = (await aq1("SELECT status FROM broadcasts WHERE id=?", (bid,)) or {}).get("status")
+        if status != "running": break
+        rows = await aqa("SELECT user_id FROM broadcast_recipients WHERE broadcast_id=? AND state=0 "
+                         "ORDER BY user_id LIMIT ?", (bid, BCAST_BATCH))
+        if not rows:
+            await aqx("UPDATE broadcasts SET status='done',finished_at=NOW() WHERE id=?", (bid,)); status = "done"; break
+        res = list(await asyncio.gather(*(one(r["user_id"]) for r in rows)))
+        await arun(_broadcast_save, bid, [r["user_id"] for r in rows], res)
+        sent += res.count(1); failed += res.count(2)
+        if time.monotonic() - last >= BCAST_PROGRESS: last = time.monotonic(); await progress("running")
+    await progress(status)
+
+def launch_broadcast(bot, bid):
+    if bid in _BROADCASTS: return
+    task = asyncio.get_running_loop().create_task(run_broadcast(bot, bid))
+    _BROADCASTS[bid] = task
+    def done(t):
+        _BROADCASTS.pop(bid, None)
+        if not t.cancelled() and t.exception(): print(f"⚠️ Broadcast #{bid}: {t.exception()}")
+    task.add_done_callback(done)
+
+async def broadcast_stop(u, ctx):
+    q = u.callback_query; bid = int(q.data.split("_")[1]); uid = q.from_user.id
+    b = await aq1("SELECT admin_id FROM broadcasts WHERE id=?", (bid,))
+    if not b or (b["admin_id"] != uid and not is_admin(uid)): await q.answer(); return
+    await aqx("UPDATE broadcasts SET status='cancelled',finished_at=NOW() WHERE id=? AND status='running'", (bid,))
+    await q.answer("⏹️ Stopping after the current batch.", show_alert=True)
+
+async def broadcast_resume_job(ctx: ContextTypes.DEFAULT_TYPE):
+    """Pick up broadcasts marked running that have no task: after a restart,
+    or when a task died on a database error (its last batch is sent again)."""
+    for r in await aqa("SELECT id FROM broadcasts WHERE status='running'"): launch_broadcast(ctx.bot, r["id"])
+
 async def ann_start(u, ctx):
     q = u.callback_query; ctx.user_data.update({"wf": "ann_title"}); ctx.user_data.pop("ann_photo", "")
     await safe_edit(q, "📢 Enter announcement title:", reply_markup=cancel_kb())
@@ -2142,7 +3357,7 @@ async def adm_delcat_list(u, ctx):
 async def adm_delcat_do(u, ctx):
     q = u.callback_query; cid = int(q.data.split("_")[1])
     qx("UPDATE products SET category_id=0 WHERE category_id=?", (cid,))
-    qx("DELETE FROM categories WHERE id=?", (cid,)); await adm_cats(u, ctx)
+    qx("DELETE FROM categories WHERE id=?", (cid,)); bump_catalogue(); await adm_cats(u, ctx)
 
 async def adm_cat_assign(u, ctx):
     q = u.callback_query; cid = int(q.data.split("_")[2])
@@ -2156,7 +3371,7 @@ async def adm_cat_assign(u, ctx):
 async def adm_togglecat(u, ctx):
     q = u.callback_query; p = q.data.split("_"); pid, cid = int(p[1]), int(p[2])
     row = q1("SELECT category_id FROM products WHERE id=?", (pid,))
-    if row: qx("UPDATE products SET category_id=? WHERE id=?", (0 if row["category_id"] == cid else cid, pid))
+    if row: qx("UPDATE products SET category_id=? WHERE id=?", (0 if row["category_id"] == cid else cid, pid)); bump_catalogue()
     u.callback_query.data = f"cat_assign_{cid}"; await adm_cat_assign(u, ctx)
 
 async def adm_rmprod_list(u, ctx):
@@ -2174,7 +3389,7 @@ async def adm_rmprod_confirm(u, ctx):
         reply_markup=KM([IB("✅ Delete", f"rmprod_yes_{pid}"), IB("❌ No", "menu")]))
 
 async def adm_rmprod_do(u, ctx):
-    q = u.callback_query; qx("DELETE FROM products WHERE id=?", (int(q.data.split("_")[2]),))
+    q = u.callback_query; qx("DELETE FROM products WHERE id=?", (int(q.data.split("_")[2]),)); bump_catalogue()
     await safe_edit(q, "✅ Deleted.", reply_markup=back_kb())
 
 async def adm_editdesc_list(u, ctx):
@@ -2215,7 +3430,7 @@ async def adm_togglehide(u, ctx):
     q = u.callback_query; pid = int(q.data.split("_")[1])
     row = q1("SELECT name,hidden FROM products WHERE id=?", (pid,))
     if not row: await q.answer(); return
-    qx("UPDATE products SET hidden=? WHERE id=?", (0 if row["hidden"] else 1, pid))
+    qx("UPDATE products SET hidden=? WHERE id=?", (0 if row["hidden"] else 1, pid)); bump_catalogue()
     await q.answer(("Shown" if row["hidden"] else "Hidden") + ": " + row["name"], show_alert=True)
     await adm_hideprod_list(u, ctx)
 
@@ -2231,7 +3446,7 @@ async def adm_feature_list(u, ctx):
 async def adm_togglefeat(u, ctx):
     q = u.callback_query; pid = int(q.data.split("_")[1])
     row = q1("SELECT featured FROM products WHERE id=?", (pid,))
-    if row: qx("UPDATE products SET featured=? WHERE id=?", (0 if row["featured"] else 1, pid))
+    if row: qx("UPDATE products SET featured=? WHERE id=?", (0 if row["featured"] else 1, pid)); bump_catalogue()
     await adm_feature_list(u, ctx)
 
 async def adm_stock_list(u, ctx):
@@ -2312,10 +3527,9 @@ async def dispute_close_cb(u, ctx):
     r = q1("SELECT user_id,order_id FROM disputes WHERE id=?", (did,))
     qx("UPDATE disputes SET status='Resolved' WHERE id=?", (did,))
     if r:
-        try: await ctx.bot.send_message(r["user_id"],
+        OUTBOX.send(r["user_id"],
             f"✅ Dispute #{did} for order <code>{r['order_id']}</code> has been resolved.",
-            parse_mode="HTML")
-        except: pass
+            parse_mode="HTML", prio=P_CHAT)
     await q.answer("✅ Dispute closed.", show_alert=True); await adm_disputes_cb(u, ctx)
 
 async def vendor_balance_cb(u, ctx):
@@ -2361,10 +3575,9 @@ async def payout_approve(u, ctx):
        (r["amount"], r["amount"], r["vendor_id"]))
     v = q1("SELECT admin_user_id FROM vendors WHERE id=?", (r["vendor_id"],))
     if v and v.get("admin_user_id"):
-        try: await ctx.bot.send_message(v["admin_user_id"],
+        OUTBOX.send(v["admin_user_id"],
             f"✅ <b>Payout Approved!</b>\n£{r['amount']:.2f} → <code>{r['ltc_addr']}</code>",
-            parse_mode="HTML")
-        except: pass
+            parse_mode="HTML", prio=P_PAY)
     await safe_edit(q, f"✅ Payout #{rid} approved.", reply_markup=back_kb())
 
 async def payout_reject(u, ctx):
@@ -2384,12 +3597,10 @@ async def cmd_reply(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not row: await u.message.reply_text("❌ Not found."); return
     # Store reply encrypted, send plaintext to user
     qx("UPDATE messages SET reply=? WHERE id=?", (enc(msg), mid))
-    try:
-        await ctx.bot.send_message(row["user_id"],
-            f"💬 <b>Reply</b>\n<i>{hl.escape(dec(row['message']))}</i>\n\n✉️ {hl.escape(msg)}",
-            parse_mode="HTML", reply_markup=menu())
-        await u.message.reply_text(f"✅ Replied to @{row['username']}.")
-    except Exception as e: await u.message.reply_text(f"❌ {e}")
+    tell_undelivered(OUTBOX.send(row["user_id"],
+        f"💬 <b>Reply</b>\n<i>{hl.escape(dec(row['message']))}</i>\n\n✉️ {hl.escape(msg)}",
+        parse_mode="HTML", reply_markup=menu(), prio=P_CHAT), u.effective_chat.id, f"the reply to @{row['username']}")
+    await u.message.reply_text(f"✅ Replied to @{row['username']}.")
 
 async def cmd_order(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(u.effective_user.id) and not is_vendor_admin(u.effective_user.id): return
@@ -2418,11 +3629,13 @@ async def cmd_order(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_set(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(u.effective_user.id): return
-    allowed = ["min_order","bulk_threshold","bulk_pct","home_extra","ref_reward_orders","ref_reward_msg"]
+    allowed = ["min_order","bulk_threshold","bulk_pct","pay_confs","home_extra","ref_reward_orders","ref_reward_msg"]
     if not ctx.args or len(ctx.args) < 2:
         await u.message.reply_text(f"Usage: /set <key> <value>\nKeys: {', '.join(allowed)}"); return
     key = ctx.args[0]; val = " ".join(ctx.args[1:])
     if key not in allowed: await u.message.reply_text(f"⚠️ Unknown key."); return
+    if key == "pay_confs" and not (val.isdigit() and int(val) >= 1):
+        await u.message.reply_text("⚠️ pay_confs must be a whole number of at least 1."); return
     ss(key, val); await u.message.reply_text(f"✅ {key} = {val}")
 
 async def cmd_invoice(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -2480,20 +3693,22 @@ async def cmd_myorder(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_search(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not ctx.args: await u.message.reply_text("Usage: /search <term>"); return
-    term="%"+" ".join(ctx.args)+"%"
-    rows=qa("SELECT id,name FROM products WHERE (name LIKE ? OR description LIKE ?) AND hidden=0 ORDER BY name",(term,term))
-    if not rows: await u.message.reply_text("🔍 No products found."); return
-    await u.message.reply_text(f"🔍 <b>{len(rows)} results</b>",parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup([[IB(f"🌿 {r['name']}",f"prod_{r['id']}")] for r in rows]+[[IB("⬅️ Menu","menu")]]))
+    term=" ".join(ctx.args); ctx.user_data["srch_q"]=term
+    res=await arun(search_page,term)
+    if not res: await u.message.reply_text("🔍 No products found."); return
+    await u.message.reply_text(res[0],parse_mode="HTML",reply_markup=res[1])
+
+async def search_more(u, ctx):
+    q = u.callback_query; term = ctx.user_data.get("srch_q")
+    res = await arun(search_page, term, int(q.data[5:])) if term else None
+    if not res: await safe_edit(q, "🔍 Search expired — search again.", reply_markup=back_kb()); return
+    await safe_edit(q, res[0], parse_mode="HTML", reply_markup=res[1])
 
 async def cmd_top(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = u.effective_user.id
     if not is_admin(uid) and not is_vendor_admin(uid): return
     vid = get_vid(ctx, uid) if is_vendor_admin(uid) else None
-    if vid:
-        rows = qa("SELECT p.name,p.views FROM products p WHERE p.vendor_id=? ORDER BY p.views DESC LIMIT 10",(vid,))
-    else:
-        rows = qa("SELECT p.name,p.views FROM products p ORDER BY p.views DESC LIMIT 10")
+    rows = await arun(top_products, vid)
     if not rows: await u.message.reply_text("📊 No data yet."); return
     txt = "🔥 <b>Top Products</b>\n━━━━━━━━━━━━━━━━━━━━\n\n"
     medals = ["🥇","🥈","🥉"]+["🏅"]*7
@@ -2513,7 +3728,7 @@ async def cmd_copy(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     new_pid = qxi("INSERT INTO products(vendor_id,name,description,photo,hidden,tiers,stock,featured,category_id) "
                   "VALUES(?,?,?,?,0,?,?,?,?)",
                   (vid, r["name"]+" (Copy)", r.get("description",""), r.get("photo",""),
-                   r.get("tiers","[]"), -1, 0, r.get("category_id",0)))
+                   r.get("tiers","[]"), -1, 0, r.get("category_id",0))); bump_catalogue()
     await u.message.reply_text(
         f"✅ Product copied! New ID: #{new_pid}", parse_mode="HTML", reply_markup=menu())
 
@@ -2527,20 +3742,19 @@ async def cmd_dispute(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if o["status"] not in ("Paid","Dispatched"): await u.message.reply_text("⚠️ Can only dispute confirmed orders."); return
     # Store dispute reason encrypted
     did=qxi("INSERT INTO disputes(order_id,user_id,reason) VALUES(?,?,?)",(oid,uid,enc(reason)))
-    try: await ctx.bot.send_message(ADMIN_ID,f"⚠️ <b>DISPUTE #{did}</b>\nOrder <code>{oid}</code>\nUser: <code>{uid}</code>\nReason: {hl.escape(reason)}",parse_mode="HTML")
-    except: pass
+    OUTBOX.send(ADMIN_ID,f"⚠️ <b>DISPUTE #{did}</b>\nOrder <code>{oid}</code>\nUser: <code>{uid}</code>\nReason: {hl.escape(reason)}",parse_mode="HTML", prio=P_CHAT)
     await u.message.reply_text(f"⚠️ Dispute #{did} raised for order <code>{oid}</code>. Admin will review within 24h.",parse_mode="HTML")
 
 async def cmd_ltccheck(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(u.effective_user.id): return
     try:
         active_wallet=get_active_wallet()
-        data=requests.get(f"https://api.blockcypher.com/v1/ltc/main/addrs/{active_wallet}/balance",timeout=10).json()
-        bal_ltc=data.get("balance",0)/100000000; unconf=data.get("unconfirmed_balance",0)/100000000; rate=ltc_price()
+        bal,unconf=await CHAIN.balance(active_wallet)
+        bal_ltc=bal/SAT; unconf=unconf/SAT; rate=ltc_price()
         await u.message.reply_text(
             f"💠 <b>Platform LTC Wallet</b>\n━━━━━━━━━━━━━━━━━━━━\n<code>{active_wallet}</code>\n\n"
             f"✅ Confirmed: <b>{bal_ltc:.6f} LTC</b> (≈ £{bal_ltc*rate:.2f})\n"
-            f"⏳ Unconfirmed: <b>{unconf:.6f} LTC</b>\n📊 Rate: £{rate:.2f}",parse_mode="HTML")
+            f"⏳ Unconfirmed: <b>{unconf:.6f} LTC</b>\n📊 Rate: £{rate:.2f} ({RATES.info()})",parse_mode="HTML")
     except Exception as e: await u.message.reply_text(f"❌ Could not fetch: {e}")
 
 async def cmd_addproduct(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -2556,12 +3770,9 @@ async def cmd_cancel(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # ══════════════════════════════════════════════════════════════════════════════
 async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid=u.effective_user.id; txt=(u.message.text or "").strip()
-    if is_banned(uid): await u.message.reply_text("🚫 You are banned."); return
-    if is_admin(uid) or is_vendor_admin(uid):
-        qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
-           (uid, u.effective_user.username or ""))
-    elif not is_known(uid):
-        await u.message.reply_text("👋 Please /start first."); return
+    st=await arun(gate, uid, u.effective_user.username)
+    if st=="banned": await u.message.reply_text("🚫 You are banned."); return
+    if st=="unknown": await u.message.reply_text("👋 Please /start first."); return
     wf=ctx.user_data.get("wf")
 
     if wf=="co_name":
@@ -2579,11 +3790,10 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         t,_=co_summary(ctx.user_data,uid); await u.message.reply_text(t,parse_mode="HTML",reply_markup=co_kb(ctx.user_data))
 
     elif wf=="search":
-        term="%"+txt+"%"; ctx.user_data["wf"]=None
-        rows=qa("SELECT id,name FROM products WHERE (name LIKE ? OR description LIKE ?) AND hidden=0 ORDER BY name",(term,term))
-        if not rows: await u.message.reply_text("🔍 No products found.",reply_markup=menu()); return
-        await u.message.reply_text(f"🔍 <b>{len(rows)} results for '{hl.escape(txt)}'</b>",parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([[IB(f"🌿 {r['name']}",f"prod_{r['id']}")] for r in rows]+[[IB("⬅️ Back","menu")]]))
+        ctx.user_data.update({"wf":None,"srch_q":txt})
+        res=await arun(search_page,txt)
+        if not res: await u.message.reply_text("🔍 No products found.",reply_markup=menu()); return
+        await u.message.reply_text(res[0],parse_mode="HTML",reply_markup=res[1])
 
     elif wf=="contact":
         uname=u.effective_user.username or str(uid); vid=ctx.user_data.get("contact_vid",1)
@@ -2592,8 +3802,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         vendor=q1("SELECT admin_user_id FROM vendors WHERE id=?",(vid,))
         notify=[ADMIN_ID]+([vendor["admin_user_id"]] if vendor and vendor.get("admin_user_id") and vendor["admin_user_id"]!=ADMIN_ID else [])
         for rid in notify:
-            try: await ctx.bot.send_message(rid,f"💬 @{uname} #{mid}\n{hl.escape(txt)}\n/reply {mid}",parse_mode="HTML")
-            except: pass
+            OUTBOX.send(rid,f"💬 @{uname} #{mid}\n{hl.escape(txt)}\n/reply {mid}",parse_mode="HTML", prio=P_CHAT)
         await u.message.reply_text("✅ Message sent!",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="ann_title":
@@ -2605,15 +3814,12 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     elif wf=="ann_body":
         title=ctx.user_data.pop("ann_title",""); photo=ctx.user_data.pop("ann_photo",""); vid=get_vid(ctx,uid)
-        qx("INSERT INTO announcements(vendor_id,title,body,photo) VALUES(?,?,?,?)",(vid,title,txt,photo))
-        uids=qa("SELECT user_id FROM users WHERE banned=0"); sent=0
-        for r in uids:
-            try:
-                fn=(ctx.bot.send_photo(r["user_id"],photo,caption=f"📢 <b>{hl.escape(title)}</b>\n\n{hl.escape(txt)}",parse_mode="HTML")
-                    if photo else ctx.bot.send_message(r["user_id"],f"📢 <b>{hl.escape(title)}</b>\n\n{hl.escape(txt)}",parse_mode="HTML"))
-                await fn; sent+=1
-            except: pass
-        await u.message.reply_text(f"✅ Broadcast to {sent} users!"); ctx.user_data["wf"]=None
+        aid=qxi("INSERT INTO announcements(vendor_id,title,body,photo) VALUES(?,?,?,?)",(vid,title,txt,photo))
+        bid,total=await arun(create_broadcast,aid,uid); ctx.user_data["wf"]=None
+        m=await u.message.reply_text(f"📢 <b>Broadcast #{bid}</b> — queued for {total} users.",parse_mode="HTML",
+            reply_markup=KM([IB("⏹️ Stop",f"bcstop_{bid}")]))
+        await aqx("UPDATE broadcasts SET progress_chat=?,progress_msg=? WHERE id=?",(m.chat_id,m.message_id,bid))
+        launch_broadcast(ctx.bot,bid)
 
     elif wf=="review_text":
         import re as _re
@@ -2647,18 +3853,18 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif wf=="add_desc":
         d=ctx.user_data; vid=get_vid(ctx,uid); d["wf"]=None
         pid=qxi("INSERT INTO products(vendor_id,name,description,photo,hidden,tiers,stock) VALUES(?,?,?,?,0,?,?)",
-                (vid,d["nm"],txt,d.get("ph",""),json.dumps(TIERS),-1))
+                (vid,d["nm"],txt,d.get("ph",""),json.dumps(TIERS),-1)); bump_catalogue()
         await u.message.reply_text(
             f"✅ <b>{hl.escape(d['nm'])}</b> added! ID: #{pid}",
             parse_mode="HTML",reply_markup=menu())
 
     elif wf=="edit_name":
         pid=ctx.user_data.get("edit_name_pid")
-        qx("UPDATE products SET name=? WHERE id=?",(txt,pid))
+        qx("UPDATE products SET name=? WHERE id=?",(txt,pid)); bump_catalogue()
         await u.message.reply_text(f"✅ Renamed to <b>{hl.escape(txt)}</b>!",parse_mode="HTML",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="edit_desc":
-        qx("UPDATE products SET description=? WHERE id=?",(txt,ctx.user_data.get("edit_pid")))
+        qx("UPDATE products SET description=? WHERE id=?",(txt,ctx.user_data.get("edit_pid"))); bump_catalogue()
         await u.message.reply_text("✅ Description updated!",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="edit_tiers":
@@ -2673,13 +3879,13 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
             except: errs.append(f"Line {i}: invalid — use qty,price or qty,price,min_qty")
         if errs or not new: await u.message.reply_text("❌ "+("\n".join(errs or ["No valid tiers."]))); return
         new.sort(key=lambda t:t["qty"])
-        qx("UPDATE products SET tiers=? WHERE id=?",(json.dumps(new),pid))
+        qx("UPDATE products SET tiers=? WHERE id=?",(json.dumps(new),pid)); bump_catalogue()
         await u.message.reply_text("✅ Tiers updated!",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="set_stock":
         try: sv=int(txt); assert sv>=-1
         except: await u.message.reply_text("⚠️ Enter a number (-1 for unlimited)."); return
-        qx("UPDATE products SET stock=? WHERE id=?",(sv,ctx.user_data.get("stock_pid")))
+        qx("UPDATE products SET stock=? WHERE id=?",(sv,ctx.user_data.get("stock_pid"))); bump_catalogue()
         await u.message.reply_text(f"✅ Stock set to {'∞' if sv==-1 else sv}.",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="flash_set":
@@ -2687,7 +3893,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try: pct=float(parts[0].strip())/100; hrs=float(parts[1].strip()); assert 0<pct<=1 and hrs>0
         except: await u.message.reply_text("⚠️ Format: PCT,HOURS e.g. 20,4"); return
         pid=ctx.user_data.get("flash_pid"); exp=(datetime.now()+timedelta(hours=hrs)).isoformat()
-        qx("INSERT INTO flash_sales(product_id,pct,expires,active) VALUES(?,?,?,1) ON CONFLICT(product_id) DO UPDATE SET pct=?,expires=?,active=1",(pid,pct,exp,pct,exp))
+        qx("INSERT INTO flash_sales(product_id,pct,expires,active) VALUES(?,?,?,1) ON CONFLICT(product_id) DO UPDATE SET pct=?,expires=?,active=1",(pid,pct,exp,pct,exp)); bump_catalogue()
         r=q1("SELECT name FROM products WHERE id=?",(pid,))
         await u.message.reply_text(f"🔥 Flash sale set!",reply_markup=menu()); ctx.user_data["wf"]=None
 
@@ -2696,8 +3902,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         ltc_addr=txt
         rid=qxi("INSERT INTO payout_requests(vendor_id,amount,ltc_addr) VALUES(?,?,?)",(vid,amount,ltc_addr))
         v=q1("SELECT name FROM vendors WHERE id=?",(vid,))
-        try: await ctx.bot.send_message(ADMIN_ID,f"💰 <b>PAYOUT REQUEST #{rid}</b>\n{hl.escape(v['name'] if v else '?')} — £{amount:.2f}\n📤 <code>{ltc_addr}</code>",parse_mode="HTML")
-        except: pass
+        OUTBOX.send(ADMIN_ID,f"💰 <b>PAYOUT REQUEST #{rid}</b>\n{hl.escape(v['name'] if v else '?')} — £{amount:.2f}\n📤 <code>{ltc_addr}</code>",parse_mode="HTML", prio=P_PAY)
         await u.message.reply_text(f"✅ Payout request #{rid} submitted!",reply_markup=menu())
 
     elif wf=="ban_user":
@@ -2705,7 +3910,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try: bid=int(txt.strip())
         except: await u.message.reply_text("⚠️ Numeric user_id only."); return
         if bid==ADMIN_ID: await u.message.reply_text("❌ Cannot ban owner."); ctx.user_data["wf"]=None; return
-        qx("UPDATE users SET banned=1 WHERE user_id=?",(bid,))
+        qx("UPDATE users SET banned=1 WHERE user_id=?",(bid,)); forget_principal(bid)
         await u.message.reply_text(f"🚫 User <code>{bid}</code> banned.",parse_mode="HTML",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="custnote_uid":
@@ -2726,21 +3931,20 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif wf=="drop_msg_user":
         oid=ctx.user_data.get("dc_oid"); uname=u.effective_user.username or str(uid)
         qx("INSERT INTO drop_chats(order_id,user_id,sender,message) VALUES(?,?,?,?)",(oid,uid,"user",enc(txt)))
-        o=q1("SELECT vendor_id FROM orders WHERE id=?",(oid,))
+        o=q1("SELECT vendor_id,chat_closed FROM orders WHERE id=?",(oid,))
         vendor=q1("SELECT admin_user_id FROM vendors WHERE id=?",(o["vendor_id"],)) if o else None
         notify=[ADMIN_ID]+([vendor["admin_user_id"]] if vendor and vendor.get("admin_user_id") and vendor["admin_user_id"]!=ADMIN_ID else [])
         for rid in notify:
-            try: await ctx.bot.send_message(rid,f"💬 Drop Chat {oid}\n@{uname}: {hl.escape(txt)}",parse_mode="HTML",reply_markup=dc_admin_kb(oid))
-            except: pass
-        await u.message.reply_text(f"✅ Sent!\n\n{fmt_chat(oid)}"[:4000],parse_mode="HTML",reply_markup=dc_user_kb(oid,gs("cc_"+oid,"0")=="1"))
+            OUTBOX.send(rid,f"💬 Drop Chat {oid}\n@{uname}: {hl.escape(txt)}",parse_mode="HTML",reply_markup=dc_admin_kb(oid), prio=P_CHAT)
+        await u.message.reply_text(f"✅ Sent!\n\n{fmt_chat(oid)}"[:4000],parse_mode="HTML",reply_markup=dc_user_kb(oid,bool(o and o["chat_closed"])))
         ctx.user_data["wf"]=None
 
     elif wf=="drop_msg_admin":
-        oid=ctx.user_data.get("dc_oid"); row=q1("SELECT user_id FROM orders WHERE id=?",(oid,))
+        oid=ctx.user_data.get("dc_oid"); row=q1("SELECT user_id,chat_closed FROM orders WHERE id=?",(oid,))
         if not row: await u.message.reply_text("❌ Not found."); ctx.user_data["wf"]=None; return
         qx("INSERT INTO drop_chats(order_id,user_id,sender,message) VALUES(?,?,?,?)",(oid,row["user_id"],"admin",enc(txt)))
-        try: await ctx.bot.send_message(row["user_id"],f"🏪 <b>Vendor Message</b>\n━━━━━━━━━━━━━━━━━━━━\n\n{fmt_chat(oid)}",parse_mode="HTML",reply_markup=dc_user_kb(oid,gs("cc_"+oid,"0")=="1"))
-        except: pass
+        OUTBOX.send(row["user_id"],f"🏪 <b>Vendor Message</b>\n━━━━━━━━━━━━━━━━━━━━\n\n{fmt_chat(oid)}",parse_mode="HTML",reply_markup=dc_user_kb(oid,bool(row["chat_closed"])),
+                    prio=P_CHAT, key=("dc", oid))  # the whole transcript: only the latest matters
         await u.message.reply_text("✅ Sent.",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="disc_code":
@@ -2760,7 +3964,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         parts=txt.split(None,1)
         emoji,name=(parts[0],parts[1]) if len(parts)==2 and len(parts[0])<=2 else ("🌿",parts[0]) if len(parts)==1 else (None,None)
         if not name: await u.message.reply_text("⚠️ Format: 🍃 Category Name"); return
-        vid=get_vid(ctx,uid); qxi("INSERT INTO categories(vendor_id,name,emoji) VALUES(?,?,?)",(vid,name,emoji))
+        vid=get_vid(ctx,uid); qxi("INSERT INTO categories(vendor_id,name,emoji) VALUES(?,?,?)",(vid,name,emoji)); bump_catalogue()
         await u.message.reply_text(f"✅ {emoji} {hl.escape(name)} created!",parse_mode="HTML",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="order_note":
@@ -2778,7 +3982,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try: new_id=int(txt.strip())
         except: await u.message.reply_text("⚠️ Numeric user_id only."); return
         if q1("SELECT 1 FROM admins WHERE user_id=?",(new_id,)): await u.message.reply_text("⚠️ Already admin."); ctx.user_data["wf"]=None; return
-        qx("INSERT INTO admins(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",(new_id,str(new_id)))
+        qx("INSERT INTO admins(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",(new_id,str(new_id))); forget_principal(new_id)
         try:
             info=await ctx.bot.get_chat(new_id); un=info.username or info.first_name or str(new_id)
             qx("UPDATE admins SET username=? WHERE user_id=?",(un,new_id))
@@ -2792,13 +3996,11 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try: com=float(parts[4]); adm_id=int(parts[5])
         except: await u.message.reply_text("⚠️ Invalid commission or admin_user_id."); return
         vid=qxi("INSERT INTO vendors(name,emoji,description,ltc_addr,commission_pct,admin_user_id) VALUES(?,?,?,?,?,?)",
-                (parts[0],parts[1],parts[2],parts[3],com,adm_id))
-        try:
-            await ctx.bot.send_message(adm_id,
-                f"🎉 <b>Welcome to PhiVara Network!</b>\n\n"
-                f"Your shop <b>{hl.escape(parts[0])}</b> is live.\nUse /admin to manage it.",
-                parse_mode="HTML")
-        except: pass
+                (parts[0],parts[1],parts[2],parts[3],com,adm_id)); forget_principal(adm_id); bump_catalogue()
+        OUTBOX.send(adm_id,
+            f"🎉 <b>Welcome to PhiVara Network!</b>\n\n"
+            f"Your shop <b>{hl.escape(parts[0])}</b> is live.\nUse /admin to manage it.",
+            parse_mode="HTML", prio=P_CHAT)
         await u.message.reply_text(f"✅ <b>{hl.escape(parts[0])}</b> added as Vendor #{vid}!",
             parse_mode="HTML",reply_markup=menu()); ctx.user_data["wf"]=None
 
@@ -2820,10 +4022,9 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
             if vendor and vendor.get("admin_user_id") and vendor["admin_user_id"]!=ADMIN_ID:
                 notify_ids.append(vendor["admin_user_id"])
             for rid in notify_ids:
-                try: await ctx.bot.send_message(rid,
+                OUTBOX.send(rid,
                     f"❓ <b>New Question on {hl.escape(prod['name'])}</b>\n{hl.escape(txt[:200])}\n\nUse ❓ Q&A in admin panel to answer.",
-                    parse_mode="HTML")
-                except: pass
+                    parse_mode="HTML", prio=P_CHAT)
         await u.message.reply_text("✅ Question submitted! You'll see the answer on the product page.",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="qa_answer":
@@ -2832,10 +4033,9 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         # Notify the customer who asked
         asked=q1("SELECT user_id,question,product_id FROM product_qa WHERE id=?",(qid,))
         if asked:
-            try: await ctx.bot.send_message(asked["user_id"],
+            OUTBOX.send(asked["user_id"],
                 f"✅ <b>Your question was answered!</b>\n<i>{hl.escape(asked['question'][:100])}</i>\n\n💬 {hl.escape(txt)}",
-                parse_mode="HTML",reply_markup=KM([IB("🛍️ View Product",f"prod_{asked['product_id']}")]))
-            except: pass
+                parse_mode="HTML",reply_markup=KM([IB("🛍️ View Product",f"prod_{asked['product_id']}")]), prio=P_CHAT)
         await u.message.reply_text("✅ Answer posted!",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="tag_add":
@@ -2877,7 +4077,7 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try: hr=int(txt.strip()); assert 1<=hr<=23
         except: await u.message.reply_text("⚠️ Enter a number 1–23 (e.g. 11 for 11am)."); return
         vid=ctx.user_data.get("cutoff_vid",1)
-        qx("UPDATE vendors SET cutoff_hour=? WHERE id=?",(hr,vid))
+        qx("UPDATE vendors SET cutoff_hour=? WHERE id=?",(hr,vid)); forget_principal(); bump_catalogue()
         await u.message.reply_text(f"✅ Cutoff set to {hr}:00.",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="inline_msg_reply":
@@ -2885,12 +4085,10 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         row=q1("SELECT user_id,username,message FROM messages WHERE id=?",(mid,))
         if not row: await u.message.reply_text("❌ Not found."); ctx.user_data["wf"]=None; return
         qx("UPDATE messages SET reply=? WHERE id=?",(enc(txt),mid))
-        try:
-            await ctx.bot.send_message(row["user_id"],
-                f"💬 <b>Reply to your message</b>\n<i>{hl.escape(dec(row['message'])[:100])}</i>\n\n✉️ {hl.escape(txt)}",
-                parse_mode="HTML",reply_markup=menu())
-            await u.message.reply_text(f"✅ Replied to @{row['username'] or mid}.",reply_markup=menu())
-        except Exception as e: await u.message.reply_text(f"❌ Could not send: {e}")
+        tell_undelivered(OUTBOX.send(row["user_id"],
+            f"💬 <b>Reply to your message</b>\n<i>{hl.escape(dec(row['message'])[:100])}</i>\n\n✉️ {hl.escape(txt)}",
+            parse_mode="HTML",reply_markup=menu(),prio=P_CHAT), u.effective_chat.id, f"the reply to @{row['username'] or mid}")
+        await u.message.reply_text(f"✅ Replied to @{row['username'] or mid}.",reply_markup=menu())
         ctx.user_data["wf"]=None
 
     elif wf=="bundle_new":
@@ -2907,12 +4105,12 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif wf=="edit_store_name":
         vid=ctx.user_data.get("store_name_vid",1)
         if not txt.strip(): await u.message.reply_text("⚠️ Name cannot be empty."); return
-        qx("UPDATE vendors SET name=? WHERE id=?",(txt.strip(),vid))
+        qx("UPDATE vendors SET name=? WHERE id=?",(txt.strip(),vid)); forget_principal(); bump_catalogue()
         await u.message.reply_text(f"✅ Store renamed to <b>{hl.escape(txt.strip())}</b>!",parse_mode="HTML",reply_markup=menu()); ctx.user_data["wf"]=None
 
     elif wf=="edit_about":
         vid=ctx.user_data.get("about_vid",1)
-        qx("UPDATE vendors SET about=? WHERE id=?",(txt,vid))
+        qx("UPDATE vendors SET about=? WHERE id=?",(txt,vid)); forget_principal(); bump_catalogue()
         await u.message.reply_text("✅ About page updated!",reply_markup=menu()); ctx.user_data["wf"]=None
 
     else:
@@ -2921,8 +4119,9 @@ async def on_message(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def on_photo(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid=u.effective_user.id; wf=ctx.user_data.get("wf"); ph=u.message.photo[-1].file_id
     if is_admin(uid) or is_vendor_admin(uid):
-        qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
-           (uid, u.effective_user.username or ""))
+        if not is_known(uid):
+            qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
+               (uid, u.effective_user.username or "")); forget_principal(uid)
     elif not is_known(uid): return
     if wf=="add_photo":
         ctx.user_data.update({"ph":ph,"wf":"add_title"})
@@ -2934,49 +4133,185 @@ async def on_photo(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # ══════════════════════════════════════════════════════════════════════════════
 # BACKGROUND JOBS
 # ══════════════════════════════════════════════════════════════════════════════
+PAY_TOL = 0.02   # relative gap allowed between expected and received LTC
+
+def pay_confs():
+    """Confirmations a payment needs before its order is paid; 1 if the setting is unusable."""
+    try: return max(int(gs("pay_confs", "1")), 1)
+    except ValueError: return 1
+_PAY_STEP = math.log1p(PAY_TOL)
+
+class _PayIndex:
+    """Pending orders bucketed by log(expected litoshi) in PAY_TOL-wide steps, so
+    an amount only has to be compared with the orders in the buckets around it."""
+    def __init__(self, orders):
+        self.b = {}
+        for o in orders:
+            o["sat"] = round(o["ltc"] * SAT)
+            if o["sat"] > 0: self.b.setdefault(self._key(o["sat"]), []).append(o)
+
+    def _key(self, sat): return int(math.log(sat) // _PAY_STEP)
+
+    def match(self, sat):
+        """(order, other orders that fit equally well) or (None, []). Closest amount
+        wins, then the oldest order; a matched order leaves the index."""
+        k = self._key(sat)
+        fits = [o for i in range(k - 2, k + 3) for o in self.b.get(i, ()) if abs(sat - o["sat"]) < o["sat"] * PAY_TOL]
+        if not fits: return None, []
+        fits.sort(key=lambda o: (abs(sat - o["sat"]), o["created_at"], o["id"]))
+        best = fits[0]; self.b[self._key(best["sat"])].remove(best)
+        return best, [o for o in fits[1:] if abs(sat - o["sat"]) == abs(sat - best["sat"])]
+
+async def notify_paid(ctx, oid, paid, ltc_received, confirmations, txid, ties=()):
+    """Tell the customer and the admins that an on-chain payment settled order oid."""
+    r, pts, cr, new_tier = paid
+    vip_note = f"\n🏆 VIP upgrade: {new_tier}!" if new_tier else ""
+    OUTBOX.send(r["user_id"],
+        f"💠 <b>Payment Auto-Detected!</b>\n✅ Order <code>{oid}</code> confirmed!\n"
+        f"💠 {ltc_received:.6f} LTC received\n🎁 +{pts} loyalty points!{vip_note}",
+        parse_mode="HTML", reply_markup=KM([IB("📦 My Orders","orders")]), prio=P_PAY)
+    vendor_row = await aq1("SELECT admin_user_id FROM vendors WHERE id=?", (r["vendor_id"],))
+    notif = (f"💰 <b>AUTO-PAYMENT DETECTED</b>\nOrder <code>{oid}</code>\n"
+             f"💠 {ltc_received:.6f} LTC ({confirmations} conf)\nTx: <code>{txid[:30]}...</code>"
+             + (f"\n⚠️ Same amount also due on: {', '.join(o['id'] for o in ties)} — check the payer"
+                if ties else ""))
+    notify_ids = [ADMIN_ID]
+    if vendor_row and vendor_row.get("admin_user_id") and vendor_row["admin_user_id"] != ADMIN_ID:
+        notify_ids.append(vendor_row["admin_user_id"])
+    for rid in notify_ids:
+        OUTBOX.send(rid, notif, parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([[IB("🚚 Dispatch", f"adm_go_{oid}")]]), prio=P_PAY)
+
+async def give_up_payment(ctx, r, why):
+    """Stop waiting on a seen tx that was dropped or never confirmed. Its order goes
+    back to payment matching and the 48h auto-expire; the txid is kept (confirmed=-1)
+    so a still-unconfirmed copy isn't matched again, but it settles if it ever confirms."""
+    oid = r["order_id"]
+    def drop():
+        with tx() as t:
+            if not t.q1("UPDATE ltc_transactions SET confirmed=-1 WHERE txid=? AND confirmed=0 RETURNING txid",
+                        (r["txid"],)): return None
+            # Settled by hand or rejected meanwhile: nothing to reopen
+            o = t.q1("SELECT user_id FROM orders WHERE id=? AND status='Pending'", (oid,))
+            if not o: return None
+            add_timeline(oid, f"💠 Payment given up ({why}): {r['txid'][:16]}…", t)
+            # Back to the normal pending-order hold, with time for auto-expire to release it
+            t.qx("UPDATE stock_holds h SET expires=GREATEST(o.created_at+?*INTERVAL '1 second',NOW()+INTERVAL '1 hour') "
+                 "FROM orders o WHERE o.id=h.order_id AND h.order_id=?", (ORDER_HOLD, oid))
+            return o
+    o = await arun(drop)
+    if not o: return
+    OUTBOX.send(o["user_id"],
+        f"⚠️ The payment we saw for order <code>{oid}</code> never confirmed ({why}).\n"
+        f"The order is waiting for payment again — contact support if you believe it was paid.",
+        parse_mode="HTML", prio=P_PAY)
+    OUTBOX.send(ADMIN_ID, f"⚠️ Payment for <code>{oid}</code> given up ({why}).\nTx: <code>{r['txid']}</code>",
+        parse_mode="HTML", prio=P_PAY)
+
+async def confirm_tracker_job(ctx: ContextTypes.DEFAULT_TYPE):
+    """Re-poll only txs seen below pay_confs, in batched requests, and settle
+    their orders once they reach it. Txs the provider has forgotten, or that stay
+    unconfirmed for PAY_GIVEUP hours, are given up."""
+    rows = await aqa("SELECT txid,order_id,amount_ltc,confirmations,EXTRACT(EPOCH FROM NOW()-created_at)::int as age "
+                     "FROM ltc_transactions WHERE confirmed=0")
+    if not rows: return
+    try: confs = await CHAIN.confirmations([r["txid"] for r in rows])
+    except Exception as e: print(f"⚠️ Confirmation tracker ({CHAIN.name}): {e}"); return
+    need = pay_confs()
+    for r in [r for r in rows if confs.get(r["txid"], 0) < need]:
+        if r["txid"] not in confs and r["age"] > PAY_DROP:
+            await give_up_payment(ctx, r, "dropped from the network")
+        elif r["age"] > PAY_GIVEUP * 3600:
+            await give_up_payment(ctx, r, f"unconfirmed after {PAY_GIVEUP}h")
+    moved = [(r["txid"], confs[r["txid"]]) for r in rows
+             if confs.get(r["txid"], r["confirmations"]) != r["confirmations"] and confs[r["txid"]] < need]
+    if moved:
+        await aqx("UPDATE ltc_transactions l SET confirmations=c.n FROM unnest(?::text[],?::int[]) AS c(txid,n) "
+                  "WHERE l.txid=c.txid", ([m[0] for m in moved], [m[1] for m in moved]))
+    for r in rows:
+        n = confs.get(r["txid"], 0)
+        if n < need: continue
+        def settle():
+            with tx() as t:
+                t.qx("UPDATE ltc_transactions SET confirmed=1,confirmations=? WHERE txid=?", (n, r["txid"]))
+                # None if the order was confirmed by hand or rejected meanwhile
+                paid = mark_paid(t, r["order_id"], f"💠 Payment confirmed: {r['amount_ltc']:.6f} LTC · {n} conf")
+            return paid_sync(paid)
+        paid = await arun(settle)
+        if paid: await notify_paid(ctx, r["order_id"], paid, r["amount_ltc"], n, r["txid"])
+
 async def ltc_payment_detector(ctx: ContextTypes.DEFAULT_TYPE):
-    pending = qa("SELECT id,ltc,user_id,vendor_id,gbp,vendor_gbp FROM orders WHERE status='Pending' AND ltc>0 AND ship='tracked24'")
-    if not pending: return
-    active_wallet = get_active_wallet()
-    try:
-        resp = requests.get(f"https://api.blockcypher.com/v1/ltc/main/addrs/{active_wallet}/full?limit=50", timeout=15)
-        if resp.status_code != 200: return
-        txs = resp.json().get("txs", [])
-    except: return
-    for tx in txs:
-        txid = tx.get("hash","")
-        if not txid or q1("SELECT 1 FROM ltc_transactions WHERE txid=?", (txid,)): continue
-        total_sat = sum(o.get("value",0) for o in tx.get("outputs",[]) if active_wallet in o.get("addresses",[]))
-        if total_sat == 0: continue
-        ltc_received = total_sat / 100000000; confirmations = tx.get("confirmations", 0)
-        for order in pending:
-            expected = order["ltc"]
-            if expected > 0 and abs(ltc_received - expected) / expected < 0.02:
-                qx("INSERT INTO ltc_transactions(txid,order_id,amount_ltc,confirmed) VALUES(?,?,?,?) ON CONFLICT DO NOTHING",
-                   (txid, order["id"], ltc_received, 1 if confirmations > 0 else 0))
-                qx("UPDATE orders SET status='Paid' WHERE id=?", (order["id"],))
-                add_timeline(order["id"], f"💠 Auto-detected: {ltc_received:.6f} LTC · {confirmations} conf")
-                credit_vendor_balance(order["vendor_id"], order["vendor_gbp"])
-                pts, cr = add_points(order["user_id"], order["gbp"])
-                new_tier = update_vip_tier(order["user_id"])
-                vip_note = f"\n🏆 VIP upgrade: {new_tier}!" if new_tier else ""
-                try:
-                    await ctx.bot.send_message(order["user_id"],
-                        f"💠 <b>Payment Auto-Detected!</b>\n✅ Order <code>{order['id']}</code> confirmed!\n"
-                        f"💠 {ltc_received:.6f} LTC received\n🎁 +{pts} loyalty points!{vip_note}",
-                        parse_mode="HTML", reply_markup=KM([IB("📦 My Orders","orders")]))
-                except: pass
-                vendor_row = q1("SELECT admin_user_id FROM vendors WHERE id=?", (order["vendor_id"],))
-                notif = (f"💰 <b>AUTO-PAYMENT DETECTED</b>\nOrder <code>{order['id']}</code>\n"
-                         f"💠 {ltc_received:.6f} LTC ({confirmations} conf)\nTx: <code>{txid[:30]}...</code>")
-                notify_ids = [ADMIN_ID]
-                if vendor_row and vendor_row.get("admin_user_id") and vendor_row["admin_user_id"] != ADMIN_ID:
-                    notify_ids.append(vendor_row["admin_user_id"])
-                for rid in notify_ids:
-                    try: await ctx.bot.send_message(rid, notif, parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup([[IB("🚚 Dispatch", f"adm_go_{order['id']}")]]))
-                    except: pass
-                break
+    """Scan every address pending orders were invoiced to, CHAIN_SCANS at a time."""
+    # Orders that already have a payment waiting on confirmations are left to confirm_tracker_job
+    pending = await aqa("SELECT id,ltc,user_id,vendor_id,created_at,COALESCE(NULLIF(ltc_addr,''),?) as addr FROM orders o "
+                        "WHERE status='Pending' AND ltc>0 AND ship='tracked24' "
+                        "AND NOT EXISTS (SELECT 1 FROM ltc_transactions l WHERE l.order_id=o.id AND l.confirmed>=0)",
+                        (PLATFORM_LTC,))
+    await aqx("DELETE FROM chain_unmatched WHERE seen_at<NOW()-?*INTERVAL '1 hour'", (CHAIN_UNMATCHED,))
+    by_addr = {}
+    for o in pending: by_addr.setdefault(o["addr"], []).append(o)
+    sem = asyncio.Semaphore(CHAIN_SCANS)
+    async def scan(addr, orders):
+        async with sem:
+            try: await scan_wallet(ctx, addr, orders)
+            except Exception as e: print(f"⚠️ Payment detector ({CHAIN.name}) {addr[:12]}…: {e}")
+    await asyncio.gather(*(scan(a, os_) for a, os_ in by_addr.items()))
+
+async def scan_wallet(ctx, addr, orders):
+    """Match new payments to addr against the orders invoiced to it."""
+    # Only blocks after the persisted cursor (less a reorg margin) are fetched, however many pages that takes
+    cur = await arun(scan_cursor, addr)
+    txs = await CHAIN.address_txs(addr, None if cur is None else cur - CHAIN_REORG)
+    top = max((ct["height"] for ct in txs if ct["height"]), default=None)
+    txs = [ct for ct in txs if ct["sat"] > 0]
+    # Payments the cursor already passed without a match (e.g. paid before the order committed) get another look
+    fetched = {ct["txid"] for ct in txs}
+    txs += [r for r in await aqa("SELECT txid,sat,confirmations FROM chain_unmatched "
+                                 "WHERE addr=? AND seen_at>NOW()-?*INTERVAL '1 hour'", (addr, CHAIN_UNMATCHED))
+            if r["txid"] not in fetched]
+    if not txs:
+        if top: await arun(set_scan_cursor, addr, top)
+        return
+    known = {r["txid"]: r["confirmed"] for r in await aqa("SELECT txid,confirmed FROM ltc_transactions WHERE txid = ANY(?)",
+                                                          ([ct["txid"] for ct in txs],))}
+    idx = _PayIndex(orders); need = pay_confs(); missed = []
+    # Oldest payments claim orders first
+    for ct in sorted(txs, key=lambda ct: (-ct["confirmations"], ct["txid"])):
+        txid = ct["txid"]
+        ltc_received = ct["sat"] / SAT; confirmations = ct["confirmations"]
+        # A given-up tx is only matched again once it actually confirms
+        if txid in known and (known[txid] >= 0 or confirmations < 1): continue
+        order, ties = idx.match(ct["sat"])
+        if not order: missed.append(ct); continue
+        def record():
+            with tx() as t:
+                t.qx("DELETE FROM chain_unmatched WHERE txid=?", (txid,))
+                t.qx("INSERT INTO ltc_transactions(txid,order_id,amount_ltc,confirmed,confirmations) VALUES(?,?,?,?,?) "
+                     "ON CONFLICT(txid) DO UPDATE SET order_id=EXCLUDED.order_id,amount_ltc=EXCLUDED.amount_ltc,"
+                     "confirmed=EXCLUDED.confirmed,confirmations=EXCLUDED.confirmations,created_at=NOW() "
+                     "WHERE ltc_transactions.confirmed=-1",
+                     (txid, order["id"], ltc_received, int(confirmations >= need), confirmations))
+                if confirmations < need:
+                    add_timeline(order["id"], f"💠 Payment seen: {ltc_received:.6f} LTC · {confirmations}/{need} conf", t)
+                    # Auto-expire no longer applies, so the stock stays held until it confirms or is given up
+                    t.qx("UPDATE stock_holds SET expires=GREATEST(expires,NOW()+?*INTERVAL '1 hour') WHERE order_id=?",
+                         (PAY_GIVEUP + 1, order["id"]))
+                    return None
+                paid = mark_paid(t, order["id"], f"💠 Auto-detected: {ltc_received:.6f} LTC · {confirmations} conf")
+            return paid_sync(paid)
+        paid = await arun(record)
+        if paid: await notify_paid(ctx, order["id"], paid, ltc_received, confirmations, txid, ties)
+        elif confirmations < need:
+            OUTBOX.send(order["user_id"],
+                f"💠 <b>Payment seen</b> for order <code>{order['id']}</code> — {ltc_received:.6f} LTC.\n"
+                f"⏳ Waiting for {need} confirmation{'s' if need != 1 else ''}; we'll message you when it's confirmed.",
+                parse_mode="HTML", prio=P_PAY)
+    if missed:
+        await aqx("INSERT INTO chain_unmatched(txid,addr,sat,confirmations) "
+                  "SELECT m.txid,?,m.sat,m.n FROM unnest(?::text[],?::bigint[],?::int[]) AS m(txid,sat,n) "
+                  "ON CONFLICT(txid) DO UPDATE SET confirmations=EXCLUDED.confirmations",
+                  (addr, [m["txid"] for m in missed], [m["sat"] for m in missed], [m["confirmations"] for m in missed]))
+    if top: await arun(set_scan_cursor, addr, top)
 
 async def pending_reminder_job(ctx: ContextTypes.DEFAULT_TYPE):
     cutoff = (datetime.now() - timedelta(hours=2)).isoformat()
@@ -2987,9 +4322,9 @@ async def pending_reminder_job(ctx: ContextTypes.DEFAULT_TYPE):
         try:
             invoice_txt, invoice_kb = build_invoice(o["id"])
             if invoice_txt:
-                await ctx.bot.send_message(o["user_id"],
+                OUTBOX.send(o["user_id"],
                     f"⏰ <b>Payment Reminder</b>\n\nOrder <code>{o['id']}</code> is still awaiting payment.\n\n" + invoice_txt,
-                    parse_mode="HTML", reply_markup=invoice_kb)
+                    parse_mode="HTML", reply_markup=invoice_kb, prio=P_PAY, key=("remind", o["id"]))
         except: pass
 
 async def review_reminder_job(ctx: ContextTypes.DEFAULT_TYPE):
@@ -2997,21 +4332,22 @@ async def review_reminder_job(ctx: ContextTypes.DEFAULT_TYPE):
     for r in qa("SELECT order_id,user_id FROM review_reminders WHERE dispatched<? AND dispatched>?",(t24,t48)):
         qx("DELETE FROM review_reminders WHERE order_id=?",(r["order_id"],))
         if q1("SELECT 1 FROM reviews WHERE order_id=?",(r["order_id"],)): continue
-        try: await ctx.bot.send_message(r["user_id"],
+        OUTBOX.send(r["user_id"],
             f"⭐ How was order <code>{r['order_id']}</code>? Leave a quick review!",
-            parse_mode="HTML",reply_markup=KM([IB("⭐ Review",f"review_{r['order_id']}")]))
-        except: pass
+            parse_mode="HTML",reply_markup=KM([IB("⭐ Review",f"review_{r['order_id']}")]), prio=P_MKT)
 
 async def auto_expire_job(ctx: ContextTypes.DEFAULT_TYPE):
     cutoff=(datetime.now()-timedelta(hours=48)).isoformat()
-    rows=qa("SELECT id,user_id FROM orders WHERE status='Pending' AND created_at<?",(cutoff,))
+    # Orders with a payment still gathering confirmations are left alone
+    rows=qa("SELECT id,user_id FROM orders o WHERE status='Pending' AND created_at<? "
+            "AND NOT EXISTS (SELECT 1 FROM ltc_transactions l WHERE l.order_id=o.id AND l.confirmed>=0)",(cutoff,))
     for r in rows:
-        qx("UPDATE orders SET status='Rejected' WHERE id=?",(r["id"],))
-        add_timeline(r["id"],"Auto-expired after 48h")
-        try: await ctx.bot.send_message(r["user_id"],
+        with tx() as t:
+            t.qx("UPDATE orders SET status='Rejected' WHERE id=?",(r["id"],))
+            add_timeline(r["id"],"Auto-expired after 48h",t); release_order(r["id"],t)
+        OUTBOX.send(r["user_id"],
             f"⏰ Order <code>{r['id']}</code> auto-cancelled (48h no payment).",
-            parse_mode="HTML",reply_markup=menu())
-        except: pass
+            parse_mode="HTML",reply_markup=menu(), prio=P_PAY)
 
 async def daily_report_job(ctx: ContextTypes.DEFAULT_TYPE):
     yesterday=(datetime.now()-timedelta(days=1)).strftime("%Y-%m-%d")
@@ -3019,12 +4355,10 @@ async def daily_report_job(ctx: ContextTypes.DEFAULT_TYPE):
               "FROM orders WHERE status IN ('Paid','Dispatched') AND created_at>=? AND created_at<?",
               (yesterday,datetime.now().strftime("%Y-%m-%d"))) or {"c":0,"s":0,"p":0}
     if orders["c"]==0: return
-    try:
-        await ctx.bot.send_message(ADMIN_ID,
-            f"📊 <b>Daily Report — {yesterday}</b>\n━━━━━━━━━━━━━━━━━━━━\n"
-            f"📦 Orders: <b>{orders['c']}</b>\n💷 Revenue: <b>£{orders['s']:.2f}</b>\n"
-            f"💰 Platform cut: <b>£{orders['p']:.2f}</b>",parse_mode="HTML")
-    except: pass
+    OUTBOX.send(ADMIN_ID,
+        f"📊 <b>Daily Report — {yesterday}</b>\n━━━━━━━━━━━━━━━━━━━━\n"
+        f"📦 Orders: <b>{orders['c']}</b>\n💷 Revenue: <b>£{orders['s']:.2f}</b>\n"
+        f"💰 Platform cut: <b>£{orders['p']:.2f}</b>",parse_mode="HTML", prio=P_MKT)
 
 async def vendor_daily_summary_job(ctx: ContextTypes.DEFAULT_TYPE):
     """Every morning send each vendor admin a summary of yesterday's activity."""
@@ -3046,17 +4380,15 @@ async def vendor_daily_summary_job(ctx: ContextTypes.DEFAULT_TYPE):
         ls_txt = ""
         if low_stock:
             ls_txt = "\n⚠️ <b>Low Stock:</b>\n" + "".join(f"  • {hl.escape(r['name'])} ({r['stock']} left)\n" for r in low_stock)
-        try:
-            await ctx.bot.send_message(v["admin_user_id"],
-                f"{v['emoji']} <b>Daily Summary — {yesterday}</b>\n━━━━━━━━━━━━━━━━━━━━\n\n"
-                f"📦 Orders yesterday: <b>{stats['c']}</b>\n"
-                f"💷 Revenue: <b>£{stats['rev']:.2f}</b>\n"
-                f"💰 Your earnings: <b>£{stats['earn']:.2f}</b>\n"
-                f"⏳ Pending orders: <b>{pending['c']}</b>\n"
-                f"💬 Unread messages: <b>{unread['c']}</b>"
-                f"{ls_txt}",
-                parse_mode="HTML")
-        except: pass
+        OUTBOX.send(v["admin_user_id"],
+            f"{v['emoji']} <b>Daily Summary — {yesterday}</b>\n━━━━━━━━━━━━━━━━━━━━\n\n"
+            f"📦 Orders yesterday: <b>{stats['c']}</b>\n"
+            f"💷 Revenue: <b>£{stats['rev']:.2f}</b>\n"
+            f"💰 Your earnings: <b>£{stats['earn']:.2f}</b>\n"
+            f"⏳ Pending orders: <b>{pending['c']}</b>\n"
+            f"💬 Unread messages: <b>{unread['c']}</b>"
+            f"{ls_txt}",
+            parse_mode="HTML", prio=P_MKT)
 
 async def low_stock_alert_job(ctx: ContextTypes.DEFAULT_TYPE):
     rows=qa("SELECT id,name,stock,vendor_id FROM products WHERE stock>0 AND stock<=3 AND hidden=0")
@@ -3067,11 +4399,32 @@ async def low_stock_alert_job(ctx: ContextTypes.DEFAULT_TYPE):
         if vendor.get("admin_user_id") and vendor["admin_user_id"]!=ADMIN_ID:
             notify.append(vendor["admin_user_id"])
         for rid in notify:
-            try: await ctx.bot.send_message(rid,
+            OUTBOX.send(rid,
                 f"⚠️ <b>Low Stock Alert</b>\n🌿 {hl.escape(r['name'])} — only <b>{r['stock']}</b> left!",
-                parse_mode="HTML")
-            except: pass
+                parse_mode="HTML", prio=P_MKT)
+
+async def hold_reap_job(ctx: ContextTypes.DEFAULT_TYPE):
+    def reap():
+        with tx() as t: held_moved(t, t.qa(f"DELETE FROM stock_holds WHERE expires<NOW() RETURNING {_HOLD_COLS}"), -1)
+    try: await arun(reap)
+    except Exception as e: print(f"⚠️ Hold reap: {e}")
 
+async def rate_refresh_job(ctx: ContextTypes.DEFAULT_TYPE):
+    await RATES.refresh()
+
+async def cart_flush_job(ctx: ContextTypes.DEFAULT_TYPE):
+    try: await arun(CART.flush); CART.reap()
+    except Exception as e: print(f"⚠️ Cart flush: {e}")
+
+async def view_flush_job(ctx: ContextTypes.DEFAULT_TYPE):
+    try: await arun(flush_views)
+    except Exception as e: print(f"⚠️ View flush: {e}")
+
+async def db_pool_reap_job(ctx: ContextTypes.DEFAULT_TYPE):
+    POOL.reap()
+    now = time.monotonic()
+    for k in [k for k, (at, _) in list(_PRINCIPALS.items()) if now - at >= PRINCIPAL_TTL]:
+        _PRINCIPALS.pop(k, None)
 
 # ── CUSTOMER ORDER NOTE ────────────────────────────────────────────────────────
 async def co_note_start(u, ctx):
@@ -3204,12 +4557,9 @@ async def holiday_cancel(u, ctx):
 # ══════════════════════════════════════════════════════════════════════════════
 async def router(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q=u.callback_query; d=q.data; uid=q.from_user.id
-    if is_banned(uid): await q.answer("🚫 You are banned.",show_alert=True); return
-    if is_admin(uid) or is_vendor_admin(uid):
-        qx("INSERT INTO users(user_id,username) VALUES(?,?) ON CONFLICT DO NOTHING",
-           (uid, u.effective_user.username or ""))
-    elif not is_known(uid):
-        await q.answer("❌ Please /start first.",show_alert=True); return
+    st=await arun(gate, uid, u.effective_user.username)
+    if st=="banned": await q.answer("🚫 You are banned.",show_alert=True); return
+    if st=="unknown": await q.answer("❌ Please /start first.",show_alert=True); return
     if d.startswith("pick_"):        await pick_weight(u,ctx); return
     if d.startswith("prodsel_"):       await product_tier_select(u,ctx); return
     if d.startswith("prodqty_"):       await product_qty_change(u,ctx); return
@@ -3299,6 +4649,8 @@ async def router(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif d.startswith("review_"):        await review_start(u,ctx)
     elif d.startswith("reviews_"):       await show_reviews(u,ctx)
     elif d.startswith("stars_"):         await pick_stars(u,ctx)
+    elif d.startswith("srch_"):          await search_more(u,ctx)
+    elif d.startswith("bcstop_"):        await broadcast_stop(u,ctx)
     elif d.startswith("contact_vid_"):   await contact_vendor(u,ctx)
     elif d.startswith("co_ship_"):       await co_ship_cb(u,ctx)
     elif d.startswith("adm_ok_"):        await adm_confirm(u,ctx)
@@ -3338,6 +4690,7 @@ async def router(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif d.startswith("show_invoice_"):  await show_invoice_cb(u,ctx)
     elif d.startswith("refresh_rate_"):  await refresh_rate_cb(u,ctx)
     elif d.startswith("timeline_"):      await view_timeline(u,ctx)
+    elif d.startswith(("ordp_","ordn_")): await view_orders(u,ctx)
     elif d == "adm_addprod_go":
         if is_admin(uid) or is_vendor_admin(uid):
             ctx.user_data["wf"]="add_photo"
@@ -3351,9 +4704,25 @@ class _Ping(BaseHTTPRequestHandler):
     def do_GET(self): self.send_response(200); self.end_headers(); self.wfile.write(b"ok")
     def log_message(self, *a): pass
 
+async def on_startup(app):
+    OUTBOX.start(app.bot)
+
+async def on_stop(app):
+    await OUTBOX.drain()
+
+async def on_shutdown(app):
+    try: flush_views()
+    except Exception as e: print(f"⚠️ View flush on shutdown: {e}")
+    try: CART.flush()
+    except Exception as e: print(f"⚠️ Cart flush on shutdown: {e}")
+    await RATES.provider.aclose()
+    await CHAIN.aclose()
+
 def main():
     Thread(target=lambda: HTTPServer(("0.0.0.0", 8080), _Ping).serve_forever(), daemon=True).start()
     init_db()
+    held_reload()
+    if SETTINGS_NOTIFY: Thread(target=settings_listener, daemon=True).start()
     print("🔷 PhiVara Network v5.1 ENCRYPTED — Starting")
 
     app = (ApplicationBuilder()
@@ -3361,6 +4730,10 @@ def main():
            .connect_timeout(30)
            .read_timeout(30)
            .write_timeout(30)
+           .concurrent_updates(_PerUserUpdates(DB_POOL_MAX))
+           .post_init(on_startup)
+           .post_stop(on_stop)
+           .post_shutdown(on_shutdown)
            .build())
 
     async def error_handler(update, context):
@@ -3391,16 +4764,24 @@ def main():
         ("owner",      cmd_owner),
     ]: app.add_handler(CommandHandler(cmd, fn))
     app.add_handler(CallbackQueryHandler(router))
+    app.add_handler(InlineQueryHandler(inline_search))
     app.add_handler(MessageHandler(filters.PHOTO, on_photo))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
     if app.job_queue:
-        app.job_queue.run_repeating(ltc_payment_detector,  interval=120,   first=60)
+        app.job_queue.run_repeating(ltc_payment_detector,  interval=CHAIN_SCAN, first=60)
+        app.job_queue.run_repeating(confirm_tracker_job,       interval=CONF_POLL,  first=30)
         app.job_queue.run_repeating(review_reminder_job,   interval=3600,  first=300)
         app.job_queue.run_repeating(auto_expire_job,       interval=3600,  first=600)
         app.job_queue.run_repeating(pending_reminder_job,  interval=7200,  first=1800)
         app.job_queue.run_repeating(daily_report_job,      interval=86400, first=3600)
         app.job_queue.run_repeating(low_stock_alert_job,       interval=3600,  first=900)
         app.job_queue.run_repeating(vendor_daily_summary_job,  interval=86400, first=7200)
+        app.job_queue.run_repeating(db_pool_reap_job,          interval=60,    first=60)
+        app.job_queue.run_repeating(view_flush_job,            interval=VIEW_FLUSH, first=VIEW_FLUSH)
+        app.job_queue.run_repeating(cart_flush_job,            interval=CART_FLUSH, first=CART_FLUSH)
+        app.job_queue.run_repeating(rate_refresh_job,          interval=RATE_TTL, first=1)
+        app.job_queue.run_repeating(broadcast_resume_job,      interval=60,    first=5)
+        app.job_queue.run_repeating(hold_reap_job,             interval=60,    first=5)
     else:
         print("⚠️ Job queue unavailable — install python-telegram-bot[job-queue]")
     print("🔷 PhiVara Network v5.1 — Running 🔒")